@@ -1,4 +1,3 @@
-import csv
 import logging
 import ntpath
 import os
@@ -9,8 +8,17 @@ from cogs.exceptions import AddError
 from datetime import datetime
 
 
-def add(path, title=None, description=None, freeze_row=0, freeze_column=0, verbose=False):
-    """Add a table (TSV or CSV) to the COGS project. This updates sheet.tsv."""
+def add(
+    path,
+    title=None,
+    description=None,
+    freeze_row=0,
+    freeze_column=0,
+    key_columns=None,
+    verbose=False,
+):
+    """Add a table (TSV or CSV) to the COGS project. This updates sheet.tsv. The key columns are
+    comma-separated column headers used to align rows when diffing the table."""
     set_logging(verbose)
     cogs_dir = validate_cogs_project()
     sheets = get_tracked_sheets(cogs_dir)
@@ -49,33 +57,25 @@ def add(path, title=None, description=None, freeze_row=0, freeze_column=0, verbo
         description = ""
 
     # Finally, add this TSV to sheet.tsv
-    with open(f"{cogs_dir}/sheet.tsv", "a") as f:
-        writer = csv.DictWriter(
-            f,
-            delimiter="\t",
-            lineterminator="\n",
-            fieldnames=[
-                "ID",
-                "Title",
-                "Path",
-                "Description",
-                "Frozen Rows",
-                "Frozen Columns",
-                "Ignore",
-            ],
-        )
-        # ID gets filled in when we add it to the Sheet
-        writer.writerow(
-            {
-                "ID": "",
-                "Title": title,
-                "Path": path,
-                "Description": description,
-                "Frozen Rows": freeze_row,
-                "Frozen Columns": freeze_column,
-                "Ignore": False,
-            }
-        )
+    # The whole file is rewritten in case it was created before some of the columns existed
+    sheet_lines = []
+    for sheet_title, details in local_sheets.items():
+        details["Title"] = sheet_title
+        sheet_lines.append(details)
+    # ID gets filled in when we add it to the Sheet
+    sheet_lines.append(
+        {
+            "ID": "",
+            "Title": title,
+            "Path": path,
+            "Description": description,
+            "Frozen Rows": freeze_row,
+            "Frozen Columns": freeze_column,
+            "Key Columns": key_columns or "",
+            "Ignore": False,
+        }
+    )
+    update_sheet(cogs_dir, sheet_lines, [])
 
     logging.info(f"{title} successfully added to project")
 
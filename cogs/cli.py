@@ -91,7 +91,7 @@ def main():
         "add",
         parents=[global_parser],
         description=add_msg,
-        usage="cogs add PATH [-t TITLE -d DESCRIPTION -r FREEZE_ROW -c FREEZE_COLUMN]",
+        usage="cogs add PATH [-t TITLE -d DESCRIPTION -r FREEZE_ROW -c FREEZE_COLUMN -k KEYS]",
     )
     sp.add_argument("path", help="Path to TSV or CSV to add to COGS project", nargs="?")
     sp.add_argument("-a", "--all", help="Add all ignored sheets from remote", action="store_true")
@@ -99,6 +99,7 @@ def main():
     sp.add_argument("-d", "--description", help="Description of sheet to add to spreadsheet")
     sp.add_argument("-r", "--freeze-row", help="Row number to freeze up to", default="0")
     sp.add_argument("-c", "--freeze-column", help="Column number to freeze up to", default="0")
+    sp.add_argument("-k", "--keys", help="Comma-separated key columns used to diff the table")
     sp.set_defaults(func=run_add)
 
     # ------------------------------- apply -------------------------------
@@ -149,14 +150,32 @@ def main():
 
     # ------------------------------- diff -------------------------------
     sp = subparsers.add_parser(
-        "diff", parents=[global_parser], description=diff_msg, usage="cogs diff [PATH ...]",
+        "diff",
+        parents=[global_parser],
+        description=diff_msg,
+        usage="cogs diff [PATH ...] [-j JOBS]",
     )
     sp.set_defaults(func=run_diff)
     sp.add_argument("paths", nargs="*", help="Paths to local sheets to diff")
+    sp.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Number of sheets to diff in parallel"
+    )
 
     # ------------------------------- fetch -------------------------------
     sp = subparsers.add_parser(
-        "fetch", parents=[global_parser], description=fetch_msg, usage="cogs fetch"
+        "fetch",
+        parents=[global_parser],
+        description=fetch_msg,
+        usage="cogs fetch [-j JOBS] [-f]",
+    )
+    sp.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Number of sheets to fetch concurrently"
+    )
+    sp.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Fetch all sheets even if the spreadsheet has not changed since the last fetch",
     )
     sp.set_defaults(func=run_fetch)
 
@@ -224,13 +243,28 @@ def main():
 
     # ------------------------------- pull -------------------------------
     sp = subparsers.add_parser(
-        "pull", parents=[global_parser], description=pull_msg, usage="cogs pull"
+        "pull",
+        parents=[global_parser],
+        description=pull_msg,
+        usage="cogs pull [-j JOBS] [-f]",
+    )
+    sp.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Number of sheets to fetch concurrently"
+    )
+    sp.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Fetch all sheets even if the spreadsheet has not changed since the last fetch",
     )
     sp.set_defaults(func=run_pull)
 
     # ------------------------------- push -------------------------------
     sp = subparsers.add_parser(
-        "push", parents=[global_parser], description=push_msg, usage="cogs push"
+        "push", parents=[global_parser], description=push_msg, usage="cogs push [-j JOBS]"
+    )
+    sp.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Number of value uploads to run concurrently"
     )
     sp.set_defaults(func=run_push)
 
@@ -261,7 +295,13 @@ def main():
 
     # -------------------------------- status --------------------------------
     sp = subparsers.add_parser(
-        "status", parents=[global_parser], description=status_msg, usage="cogs status",
+        "status",
+        parents=[global_parser],
+        description=status_msg,
+        usage="cogs status [-j JOBS]",
+    )
+    sp.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Number of sheets to diff in parallel"
     )
     sp.set_defaults(func=run_status)
 
@@ -285,6 +325,7 @@ def run_add(args):
                 description=args.description,
                 freeze_row=args.freeze_row,
                 freeze_column=args.freeze_column,
+                key_columns=args.keys,
                 verbose=args.verbose,
             )
     except CogsError as e:
@@ -347,7 +388,7 @@ def run_delete(args):
 def run_diff(args):
     """Wrapper for diff function."""
     try:
-        has_diff = diff(paths=args.paths, verbose=args.verbose)
+        has_diff = diff(paths=args.paths, jobs=args.jobs, verbose=args.verbose)
         if not has_diff:
             print("Local sheets are up to date with remote sheets (nothing to push or pull).\n")
     except CogsError as e:
@@ -358,7 +399,7 @@ def run_diff(args):
 def run_fetch(args):
     """Wrapper for fetch function."""
     try:
-        fetch(verbose=args.verbose)
+        fetch(jobs=args.jobs, force=args.force, verbose=args.verbose)
     except CogsError as e:
         logging.critical(str(e))
         sys.exit(1)
@@ -449,7 +490,7 @@ def run_open(args):
 def run_pull(args):
     """Wrapper for pull function."""
     try:
-        fetch(verbose=args.verbose)
+        fetch(jobs=args.jobs, force=args.force, verbose=args.verbose)
         merge(verbose=args.verbose)
     except CogsError as e:
         logging.critical(str(e))
@@ -459,7 +500,7 @@ def run_pull(args):
 def run_push(args):
     """Wrapper for push function."""
     try:
-        push(verbose=args.verbose)
+        push(jobs=args.jobs, verbose=args.verbose)
     except CogsError as e:
         logging.critical(str(e))
         sys.exit(1)
@@ -501,7 +542,7 @@ def run_share(args):
 def run_status(args):
     """Wrapper for status function."""
     try:
-        changes = status(verbose=args.verbose)
+        changes = status(jobs=args.jobs, verbose=args.verbose)
         if not changes:
             print("Local sheets are up to date with remote sheets (nothing to push or pull).\n")
     except CogsError as e:
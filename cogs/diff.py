@@ -1,17 +1,116 @@
 import curses
+import multiprocessing
 import os
 import re
-import tabulate
 
 from cogs.exceptions import DiffError
 from cogs.helpers import (
     get_cached_path,
     get_diff,
+    get_fingerprints,
+    get_key_columns,
     get_tracked_sheets,
+    is_unchanged,
     set_logging,
     validate_cogs_project,
 )
 
+# Column widths are computed from up to this many rows of each sheet diff, spread evenly over
+# the diff; longer cells in the other rows push the rest of their line to the right
+WIDTH_SAMPLE_ROWS = 1000
+
+# Number of characters to move left or right at a time
+SCROLL_COLUMNS = 20
+
+
+class DiffLines:
+    """The lines of one or more sheet diffs, formatted for the curses screen. The sheet diffs are
+    taken from an iterator of (sheet title, daff diff lines) only when the lines after the
+    already loaded sheets are needed, and each line is only formatted when it is displayed."""
+
+    def __init__(self, cogs_dir, sheet_diffs, sheet_details):
+        self.cogs_dir = cogs_dir
+        self.sheet_diffs = iter(sheet_diffs)
+        self.sheet_details = sheet_details
+        # The diffs that have been loaded, including those without any changes
+        self.diffs = {}
+        # Each line is a (text, formatting) pair or a (diff row, column widths) pair
+        self.lines = []
+        self.done = False
+
+    def __len__(self):
+        return len(self.lines)
+
+    def load(self):
+        """Load the lines of the next sheet diff that has changes. Return False if there are no
+        more sheet diffs."""
+        for sheet_title, sheet_diff in self.sheet_diffs:
+            self.diffs[sheet_title] = sheet_diff
+            if len(sheet_diff) > 1:
+                self.add_sheet(sheet_title, sheet_diff)
+                return True
+        self.done = True
+        return False
+
+    def load_to(self, count):
+        """Load sheet diffs until there are at least 'count' lines or all sheets are loaded."""
+        while len(self.lines) < count and not self.done:
+            self.load()
+
+    def add_sheet(self, sheet_title, sheet_diff):
+        """Add the lines for one sheet diff: the paths, headers, and a line for each diff row."""
+        path_name = re.sub(r"[^A-Za-z0-9]+", "_", sheet_title.lower())
+        remote = f"{self.cogs_dir}/tracked/{path_name}.tsv"
+        local = self.sheet_details[sheet_title]["Path"]
+        self.lines.append(("", None))
+        self.lines.append((f"--- {remote} (remote)", curses.A_BOLD))
+        self.lines.append((f"+++ {local} (local)", curses.A_BOLD))
+
+        has_col_changes = True
+        for c in set(sheet_diff[1]):
+            if c != "+++" and c != "---":
+                has_col_changes = False
+                break
+        if has_col_changes:
+            # The column changes and the column names are shown as two header rows
+            header_rows = [sheet_diff[0], sheet_diff[1]]
+            header_rows = [["" if h == "!" else h for h in hs] for hs in header_rows]
+            rows = sheet_diff[2:]
+        else:
+            header_rows = [[""] + sheet_diff[0][1:]]
+            rows = sheet_diff[1:]
+
+        # Get the column widths from the headers and a sample of the rows
+        step = max(1, len(rows) // WIDTH_SAMPLE_ROWS)
+        widths = [0] * max(len(row) for row in header_rows + rows)
+        for row in header_rows + rows[::step]:
+            for idx, cell in enumerate(row):
+                widths[idx] = max(widths[idx], len(get_cell_text(cell)))
+
+        for row in header_rows:
+            self.lines.append((row, widths))
+        self.lines.append(("  ".join("-" * w for w in widths), None))
+        self.lines.extend((row, widths) for row in rows)
+
+    def get_line(self, idx):
+        """Return the text and formatting of a line, loading more sheet diffs if needed."""
+        self.load_to(idx + 1)
+        line, fmt = self.lines[idx]
+        if isinstance(line, str):
+            return line, fmt
+        widths = fmt
+        text = "  ".join(
+            get_cell_text(cell).ljust(widths[i]) for i, cell in enumerate(line)
+        ).rstrip()
+        action = line[0]
+        if action == "+++":
+            return text, curses.color_pair(2)
+        elif action == "---":
+            return text, curses.color_pair(1)
+        elif action == "->":
+            return text, curses.color_pair(3)
+        return text, None
+
 
 def close_screen(stdscr):
     """Reset curses options and end window."""
@@ -22,189 +121,153 @@ def close_screen(stdscr):
     curses.endwin()
 
 
-def get_diff_lines(cogs_dir, diffs, sheet_details):
-    """Return the lines for a diff as an array of pairs (text, formatting)."""
-    lines = []
-    for sheet_title, sheet_diff in diffs.items():
-        details = sheet_details[sheet_title]
-        path_name = re.sub(r"[^A-Za-z0-9]+", "_", sheet_title.lower())
-        remote = f"{cogs_dir}/tracked/{path_name}.tsv"
-        local = details["Path"]
-        if len(sheet_diff) > 1:
-            lines.append(("", None))
-            lines.append((f"--- {remote} (remote)", curses.A_BOLD))
-            lines.append((f"+++ {local} (local)", curses.A_BOLD))
-            has_col_changes = True
-            for c in set(sheet_diff[1]):
-                if c != "+++" and c != "---":
-                    has_col_changes = False
-                    break
-            if has_col_changes:
-                hs1 = sheet_diff.pop(0)
-                hs2 = sheet_diff.pop(0)
-                headers = []
-                for idx in range(0, len(hs1)):
-                    h1 = hs1[idx]
-                    if h1 == "!":
-                        headers.append("")
-                    else:
-                        h2 = hs2[idx]
-                        headers.append(f"{h1}\n{h2}")
-            else:
-                headers = sheet_diff.pop(0)
-                headers[0] = ""
-            tab = tabulate.tabulate(sheet_diff, headers=headers)
-            for t in tab.split("\n"):
-                if t.startswith("+++"):
-                    lines.append((t, curses.color_pair(2)))
-                elif t.startswith("---") and not t.endswith("---"):
-                    lines.append((t, curses.color_pair(1)))
-                elif t.startswith("->"):
-                    lines.append((t, curses.color_pair(3)))
-                else:
-                    lines.append((t, None))
-    return lines
-
-
-def display_diff(cogs_dir, diffs, sheets):
-    """Display an interactive curses screen with the formatted daff diff lines."""
-    # Init the curses screen
-    stdscr = curses.initscr()
+def get_cell_text(cell):
+    """Return the text of a diff cell as a single line."""
+    if cell is None:
+        return ""
+    return str(cell).replace("\n", " ")
 
-    # Set screen/curses options
-    curses.noecho()
-    curses.cbreak()
-    curses.curs_set(0)
-    stdscr.keypad(True)
-    stdscr.scrollok(True)
 
-    # Set the color pairs
-    curses.start_color()
-    curses.use_default_colors()
-    curses.init_pair(1, curses.COLOR_RED, -1)
-    curses.init_pair(2, curses.COLOR_GREEN, -1)
-    curses.init_pair(3, curses.COLOR_CYAN, -1)
+def get_sheet_diffs(sheet_jobs, jobs=1):
+    """Yield the sheet title and daff diff lines for each sheet in sheet_jobs (dict of sheet title
+    -> get_diff arguments), in order. If 'jobs' is greater than one, the sheets are diffed in up to
+    'jobs' processes in the background, so that the first diffs can be used while the rest are
+    still running. If the generator is closed before all diffs are done, the processes are
+    terminated so that the command does not wait for them to exit. Otherwise, each sheet is only
+    diffed when its diff is needed."""
+    if jobs < 2 or len(sheet_jobs) < 2:
+        for sheet_title, args in sheet_jobs.items():
+            yield sheet_title, get_diff(*args)
+        return
+    pool = multiprocessing.Pool(processes=min(jobs, len(sheet_jobs)))
+    done = False
+    try:
+        results = []
+        for sheet_title, args in sheet_jobs.items():
+            results.append((sheet_title, pool.apply_async(get_diff, args)))
+        for sheet_title, result in results:
+            yield sheet_title, result.get()
+        done = True
+    finally:
+        if done:
+            pool.close()
+        else:
+            # Stop any diffs that are no longer needed, including the ones that are running
+            pool.terminate()
+        pool.join()
 
-    # Get the lines to display
-    lines = get_diff_lines(cogs_dir, diffs, sheets)
 
-    if not lines:
+def display_diff(cogs_dir, sheet_diffs, sheets):
+    """Display an interactive curses screen with the formatted daff diff lines of an iterator of
+    (sheet title, daff diff lines). The screen is opened as soon as the first sheet with changes has
+    been diffed, and only the lines that are shown are formatted. Return the dict of sheet title ->
+    daff diff lines that were loaded, or None if there are no changes."""
+    lines = DiffLines(cogs_dir, sheet_diffs, sheets)
+    if not lines.load():
         # Nothing to display
-        close_screen(stdscr)
         return None
 
+    # Init the curses screen
+    stdscr = curses.initscr()
     try:
-        stdscr.clear()
-        stdscr.refresh()
+        # Set screen/curses options
+        curses.noecho()
+        curses.cbreak()
+        curses.curs_set(0)
+        stdscr.keypad(True)
 
-        # Get the size of the window
-        rows, cols = stdscr.getmaxyx()
-        rows = rows - 1
+        # Set the color pairs
+        curses.start_color()
+        curses.use_default_colors()
+        curses.init_pair(1, curses.COLOR_RED, -1)
+        curses.init_pair(2, curses.COLOR_GREEN, -1)
+        curses.init_pair(3, curses.COLOR_CYAN, -1)
 
         # Tracking for current x and y
         # Row is y and col position is x
         y = 0
         x = 0
-        eof = False
+        redraw = True
 
-        # Display lines
         while True:
-            stdscr.clear()
-            stdscr.refresh()
-
-            # Get the lines to display based on current top line & size of window
-            disp_lines = lines[y : y + rows]
-
-            # Display these lines, only printing ot the size of the cols (x)
-            max_x = 0
-            for i in range(0, len(disp_lines)):
-                text = disp_lines[i][0].rstrip()
-                if len(text) > max_x:
-                    max_x = len(text)
-                text = text[x : cols + x]
-                fmt = disp_lines[i][1]
-                if fmt:
-                    stdscr.addstr(i, 0, text + "\n", fmt)
-                else:
-                    stdscr.addstr(i, 0, text + "\n")
-
-            # Add a message when we hit the EOF
-            if eof or rows > len(lines) - 2:
-                stdscr.addstr(rows - 1, 0, "~ end of diff", curses.color_pair(3) | curses.A_BOLD)
-
-            # Display current position in diff
-            if max_x < cols + x:
-                disp_x_num = max_x
-            else:
-                disp_x_num = cols + x
-
-            if len(disp_lines) < rows + x:
-                disp_y_num = len(disp_lines)
-            else:
-                disp_y_num = rows + y
-            stdscr.addstr(
-                rows,
-                0,
-                f"L{y}-{disp_y_num} of {len(lines)}, C{x}-{disp_x_num} of {max_x} | "
-                f"q = quit, t = top, b = bottom, l = leftmost, r = rightmost",
-            )
+            # Get the size of the window
+            rows, cols = stdscr.getmaxyx()
+            rows = rows - 1
+            if redraw:
+                # erase (instead of clear) lets curses only send the changed characters
+                stdscr.erase()
+
+                # Display the lines from the current top line to the size of the window
+                lines.load_to(y + rows + 1)
+                disp_lines = [lines.get_line(i) for i in range(y, min(y + rows, len(lines)))]
+                max_x = 0
+                for i, (text, fmt) in enumerate(disp_lines):
+                    max_x = max(max_x, len(text))
+                    text = text[x : cols + x - 1]
+                    if fmt:
+                        stdscr.addstr(i, 0, text, fmt)
+                    else:
+                        stdscr.addstr(i, 0, text)
+
+                # Add a message when we hit the EOF
+                if lines.done and len(disp_lines) < rows:
+                    stdscr.addstr(
+                        len(disp_lines), 0, "~ end of diff", curses.color_pair(3) | curses.A_BOLD
+                    )
+
+                # Display current position in diff
+                total = str(len(lines)) if lines.done else f"{len(lines)}+"
+                position = (
+                    f"L{y}-{y + len(disp_lines)} of {total}, C{x}-{min(max_x, cols + x)} of "
+                    f"{max_x} | q = quit, t = top, b = bottom, l = leftmost, r = rightmost"
+                )
+                stdscr.addstr(rows, 0, position[: cols - 1])
 
             # Get user input
             k = stdscr.getch()
+            old_y = y
+            old_x = x
             if k == ord("q"):
                 # Exit
-                return diffs
+                break
             elif k == ord("l"):
                 # Leftmost
                 x = 0
-                continue
             elif k == ord("t"):
                 # Top
-                eof = False
                 y = 0
-                continue
             elif k == ord("r"):
                 # Rightmost
-                if not cols > max_x:
-                    x = max_x - cols + 1
-                continue
+                x = max(0, max_x - cols + 1)
             elif k == ord("b"):
-                # Bottom
-                if not eof and not disp_y_num == len(lines):
-                    eof = True
-                    y = len(lines) - rows
-                continue
+                # Bottom (all sheets must be diffed to find it)
+                lines.load_to(float("inf"))
+                y = max(0, len(lines) - rows + 1)
             elif k == curses.KEY_DOWN:
-                if disp_y_num == len(lines):
-                    eof = True
-                elif not eof:
+                lines.load_to(y + rows + 1)
+                if y + rows <= len(lines):
                     y += 1
-                    if y + rows == len(lines) + 1:
-                        eof = True
-                continue
             elif k == curses.KEY_UP:
-                if eof:
-                    eof = False
                 if y > 0:
                     y -= 1
-                continue
             elif k == curses.KEY_RIGHT:
                 if x + cols < max_x:
-                    x += 20
-                continue
+                    x += SCROLL_COLUMNS
             elif k == curses.KEY_LEFT:
-                if x > 0:
-                    x -= 20
-                continue
+                x = max(0, x - SCROLL_COLUMNS)
+            redraw = k == curses.KEY_RESIZE or y != old_y or x != old_x
     finally:
         close_screen(stdscr)
-    return diffs
+    return lines.diffs
 
 
-def diff(paths=None, use_screen=True, verbose=False):
+def diff(paths=None, jobs=1, use_screen=True, verbose=False):
     """Return a dict of sheet title to daff diff lines. If no paths are provided, diff over all
-    sheets in the project. If use_screen, display an interactive curses screen with the diffs."""
+    sheets in the project. The sheets are diffed in up to 'jobs' processes. If use_screen, display
+    an interactive curses screen with the diffs."""
     set_logging(verbose)
+    if jobs < 1:
+        raise DiffError(f"the number of jobs must be at least 1 (got {jobs})")
     cogs_dir = validate_cogs_project()
 
     sheets = get_tracked_sheets(cogs_dir)
@@ -220,19 +283,24 @@ def diff(paths=None, use_screen=True, verbose=False):
             if details["Path"] in paths
         }
 
-    diffs = {}
+    fingerprints = get_fingerprints(cogs_dir)
+    sheet_jobs = {}
     for sheet_title, details in sheets.items():
         cached = get_cached_path(cogs_dir, sheet_title)
         local = details["Path"]
+        if is_unchanged(cogs_dir, sheet_title, local, fingerprints):
+            continue
         if os.path.exists(local) and os.path.exists(cached):
             # Consider remote (cached) the old version to diff off of
-            sheet_diff = get_diff(cached, local)
-            diffs[sheet_title] = sheet_diff
-
-    if not diffs:
+            sheet_jobs[sheet_title] = (cached, local, get_key_columns(details))
+    if not sheet_jobs:
         return None
 
+    sheet_diffs = get_sheet_diffs(sheet_jobs, jobs=jobs)
     if use_screen:
-        return display_diff(cogs_dir, diffs, sheets)
+        try:
+            return display_diff(cogs_dir, sheet_diffs, sheets)
+        finally:
+            sheet_diffs.close()
 
-    return diffs
+    return dict(sheet_diffs)
@@ -1,153 +1,170 @@
 import csv
 import json
 import logging
+import math
 import os
 import re
+import tempfile
 
 import gspread.utils
 import gspread_formatting as gf
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cogs.exceptions import FetchError
 from cogs.helpers import (
+    add_row_runs,
+    add_to_runs,
+    close_ranges,
+    get_a1_ranges,
     get_cached_path,
     get_cached_sheets,
-    get_client_from_config,
-    get_credentials,
     get_config,
+    get_fetch_state,
+    get_fingerprints,
     get_format_dict,
+    get_hash,
+    get_metadata_hash,
+    get_properties_hash,
+    get_remote_version,
     get_renamed_sheets,
+    get_session,
+    get_sheet_hashes,
     get_tracked_sheets,
     set_logging,
     validate_cogs_project,
     update_data_validation,
+    update_fetch_state,
+    update_fingerprints,
     update_format,
     update_note,
     update_sheet,
 )
-from googleapiclient import discovery
-from googleapiclient.discovery_cache.base import Cache
 
+# Maximum number of grid cells (rows * columns) to request in one spreadsheets.get call
+MAX_BATCH_CELLS = 2000000
 
-class MemoryCache(Cache):
-    """Workaround from https://github.com/googleapis/google-api-python-client/issues/325 -
-    google-api-python-client is not compatible with oauth2client >= 4.0.0"""
+# Sheets with more grid cells than this are requested and processed in windows of rows with up to
+# this many cells each, so that the memory used by a large sheet is bounded by the window size
+WINDOW_CELLS = 500000
 
-    _CACHE = {}
+# CellData fields that COGS stores: formats, notes, data validation, and the values for the TSVs
+# More fields can be requested with the "Cell Fields" key in config.tsv
+CELL_FIELDS = ["userEnteredFormat", "note", "dataValidation", "formattedValue"]
 
-    def get(self, url):
-        return MemoryCache._CACHE.get(url)
 
-    def set(self, url, content):
-        MemoryCache._CACHE[url] = content
-
-
-def clean_data_validation_rules(dv_rules, str_to_rule):
+def clean_data_validation_rules(dv_ranges, str_to_rule):
     """Clean up the data validation rules retrieved from the sheets and format them to store in
-    validiation.tsv. This also aggregates the rules by ranges."""
-    # Aggregate rules by range
-    agg_dv_rules = {}
-    for dv_rule_str, locs in dv_rules.items():
-        dv_rule = str_to_rule[dv_rule_str]
-        prev_loc = None
-        range_start = None
-        locs = sorted(locs)
-        agg_locs = []
-        for loc in locs:
-            row, col = gspread.utils.a1_to_rowcol(loc)
-            if not prev_loc:
-                prev_loc = loc
-                range_start = loc
-            else:
-                prev_row, prev_col = gspread.utils.a1_to_rowcol(prev_loc)
-                if (prev_col == col and prev_row == row - 1) or (
-                    prev_row == row and prev_col == col - 1
-                ):
-                    prev_loc = loc
-                else:
-                    if prev_loc == range_start:
-                        agg_locs.append(prev_loc)
-                    else:
-                        agg_locs.append(f"{range_start}:{prev_loc}")
-                    prev_loc = loc
-                    range_start = loc
-        # Handle last remaining location
-        if prev_loc:
-            if prev_loc == range_start:
-                agg_locs.append(prev_loc)
-            else:
-                agg_locs.append(f"{range_start}:{prev_loc}")
-        # Create loc -> rule map
-        for loc in agg_locs:
-            agg_dv_rules[loc] = dv_rule
-
-    # Format the data validation for validation.tsv
+    validiation.tsv. The cells with each rule have already been merged into rectangles."""
     dv_rows = []
-    for loc, dv_rule in agg_dv_rules.items():
+    for loc, dv_rule_str in get_a1_ranges(dv_ranges).items():
+        dv_rule = str_to_rule[dv_rule_str]
         condition = dv_rule.condition.type
         values = []
         for cv in dv_rule.condition.values:
             values.append(cv.userEnteredValue)
         dv_rows.append({"Range": loc, "Condition": condition, "Value": ", ".join(values)})
-
     return dv_rows
 
 
-def get_cell_data(cogs_dir, sheet):
-    """Get cell data from a remote sheet. Cell data includes formatting and notes.
-    Return as a map of cell location (e.g., B2) to {"format": dict, "note": str}."""
-    # Label is the range of cells in a sheet (e.g., foo!A1:B2)
-    spreadsheet_id = sheet.spreadsheet.id
-    sheet_name = sheet.title
+def fingerprints_changed(cogs_dir, fingerprints, new_fingerprints, key, filename):
+    """Return True if the file for a fingerprint key (e.g. "Formats" in format.tsv) needs to be
+    rewritten. This is the case when the fingerprint of any fetched sheet has changed, when a
+    sheet is no longer fetched, or when the file has been edited locally since the last fetch."""
+    old = {st: fingerprint.get(key) for st, fingerprint in fingerprints.items()}
+    new = {st: fingerprint[key] for st, fingerprint in new_fingerprints.items()}
+    if old != new:
+        return True
+    path = f"{cogs_dir}/{filename}"
+    index_path = f"{cogs_dir}/fingerprint.tsv"
+    if not os.path.exists(path) or not os.path.exists(index_path):
+        return True
+    return os.stat(path).st_mtime_ns > os.stat(index_path).st_mtime_ns
 
-    # Retrieve the credentials object to send request
-    config = get_config(cogs_dir)
-    if "Credentials" in config:
-        credentials = get_credentials(config["Credentials"])
-    else:
-        credentials = get_credentials()
 
-    # Build service to send request & execute
-    service = discovery.build("sheets", "v4", credentials=credentials, cache=MemoryCache())
-    request = service.spreadsheets().get(
+def get_batch_data(session, spreadsheet_id, sheets, fields):
+    """Request the cell data for a batch of sheets with one spreadsheets.get call and return the
+    response. Only the given field mask is requested."""
+
+    # Each range is the full sheet (e.g., 'foo')
+    ranges = []
+    for sheet in sheets:
+        sheet_title = sheet.title.replace("'", "''")
+        ranges.append(f"'{sheet_title}'")
+    logging.info(f"Requesting cell data for {len(sheets)} sheet(s)")
+    request = session.service.spreadsheets().get(
         spreadsheetId=spreadsheet_id,
-        ranges=f"'{sheet_name}'",
-        fields="sheets(data(rowData(values(*))))",
+        ranges=ranges,
+        fields=fields,
     )
-    resp = request.execute()
-
-    # Process response
-    cells = {}
-    idx_y = 1
-    data = resp["sheets"][0]["data"][0]
-    if "rowData" not in data:
-        # Empty sheet
-        return cells
-    for row in data["rowData"]:
-        if not row:
-            # Empty row
-            idx_y += 1
-            continue
-        idx_x = 1
-        for cell in row["values"]:
-            label = gspread.utils.rowcol_to_a1(idx_y, idx_x)
-            cell_data = {}
-            if "userEnteredFormat" in cell:
-                cell_data["format"] = cell["userEnteredFormat"]
-            else:
-                cell_data["format"] = {}
-            if "note" in cell:
-                cell_data["note"] = cell["note"].replace("\n", "\\n")
-            if "dataValidation" in cell:
-                condition = cell["dataValidation"]["condition"]
-                condition_type = condition["type"]
-                values = []
-                if "values" in condition:
-                    values = [v for v in condition["values"]]
-                cell_data["data_validation"] = {"condition": condition_type, "value": values}
-
-            cells[label] = cell_data
-            idx_x += 1
-        idx_y += 1
-    return cells
+    return session.execute(request)
+
+
+def get_windows(session, spreadsheet_id, sheet, fields):
+    """Yield the GridData of a sheet in windows of rows (e.g., 'foo'!A1:Z5000, 'foo'!A5001:Z10000,
+    ...) with up to WINDOW_CELLS cells each. Each window is only requested once the previous one
+    has been processed, so one window is held in memory at a time."""
+    sheet_title = sheet.title.replace("'", "''")
+    window_rows = max(1, WINDOW_CELLS // max(1, sheet.col_count))
+    for start in range(1, sheet.row_count + 1, window_rows):
+        end_row = min(start + window_rows - 1, sheet.row_count)
+        end = gspread.utils.rowcol_to_a1(end_row, sheet.col_count)
+        logging.info(f"Requesting cell data for rows {start} to {end_row} of '{sheet.title}'")
+        request = session.service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            ranges=[f"'{sheet_title}'!A{start}:{end}"],
+            fields=fields,
+        )
+        data = session.execute(request)["sheets"][0]["data"][0]
+        data["startRow"] = start - 1
+        yield data
+
+
+def get_fields(config):
+    """Return the field mask for the cell data of a spreadsheets.get call. This always includes
+    the fields that COGS stores (CELL_FIELDS) and any extra CellData fields from the
+    comma-separated "Cell Fields" configuration key (e.g., "effectiveFormat, hyperlink")."""
+    cell_fields = list(CELL_FIELDS)
+    for field in config.get("Cell Fields", "").split(","):
+        field = field.strip()
+        if field and field not in cell_fields:
+            cell_fields.append(field)
+    if "*" in cell_fields:
+        cell_fields = ["*"]
+    return f"sheets(properties(title),data(rowData(values({','.join(cell_fields)}))))"
+
+
+def get_batches(sheets, jobs=1):
+    """Split a list of sheets into batches that can each be requested with one spreadsheets.get
+    call. Batches are bounded by the number of grid cells (rows * columns) they cover. When more
+    than one job is used, the sheets are split into at least that many batches (if possible) so
+    that the batches can be requested concurrently."""
+    total_cells = sum([sheet.row_count * sheet.col_count for sheet in sheets])
+    max_cells = min(MAX_BATCH_CELLS, max(1, math.ceil(total_cells / jobs)))
+    batches = []
+    batch = []
+    batch_cells = 0
+    for sheet in sheets:
+        sheet_cells = sheet.row_count * sheet.col_count
+        if batch and batch_cells + sheet_cells > max_cells:
+            batches.append(batch)
+            batch = []
+            batch_cells = 0
+        batch.append(sheet)
+        batch_cells += sheet_cells
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_padded_rows(path, width):
+    """Yield the rows of a TSV, each padded with empty cells to the given width. This matches the
+    values API output."""
+    with open(path, "r") as f:
+        reader = csv.reader(f, delimiter="\t")
+        for row in reader:
+            if len(row) < width:
+                row.extend([""] * (width - len(row)))
+            yield row
 
 
 def get_remote_sheets(sheets):
@@ -178,6 +195,179 @@ def get_updated_sheet_details(tracked_sheets, remote_sheets, sheet_frozen):
     return all_sheets
 
 
+def process_batch(cogs_dir, session, spreadsheet_id, sheets, fields, values_hashes):
+    """Request the cell data for a batch of sheets (map of sheet title -> remote sheet) with one
+    spreadsheets.get call and process each sheet as soon as the response arrives (see
+    process_sheet). Return a map of sheet title -> processed details."""
+    resp = get_batch_data(session, spreadsheet_id, list(sheets.values()), fields)
+    sheet_cells = {data["properties"]["title"]: data["data"] for data in resp.get("sheets", [])}
+    del resp
+    sheet_details = {}
+    for sheet_title, sheet in sheets.items():
+        # Each sheet's data is dropped once it has been processed
+        windows = sheet_cells.pop(sheet.title, None)
+        sheet_details[sheet_title] = process_sheet(
+            cogs_dir, sheet_title, windows, values_hashes.get(sheet_title)
+        )
+    return sheet_details
+
+
+def process_sheet(cogs_dir, sheet_title, windows, values_hash=None):
+    """Process the cell data of a downloaded sheet and write its values to .cogs/tracked, unless
+    the hash of the values is the same as the previously fetched values_hash. The cell data is an
+    iterable of GridData for consecutive windows of rows, and each window is processed as it
+    arrives. Return a dict of:
+    {"formats": map of cell or range -> format JSON (as a sorted string),
+     "notes": map of cell -> note,
+     "data_validation": list of data validation rows for validation.tsv,
+     "values_hash": hash of the values}
+    This does not depend on any other sheet, so sheets can be processed concurrently."""
+    if not windows:
+        windows = []
+
+    # Cells with the same format are merged into rectangles (e.g., B2:B10001 or A1:Z1)
+    # Formats are compared by their sorted JSON string; IDs are assigned later
+    open_format_ranges = {}
+    format_ranges = []
+
+    # Add the cell to note
+    cell_to_note = {}
+
+    # Cells with the same data validation rule are also merged into rectangles
+    open_dv_ranges = {}
+    dv_ranges = []
+    str_to_rule = {}
+
+    # Values are written to a temporary file without trailing empty cells as they arrive
+    # The size of the sheet is only known once all windows have been processed
+    fd, part_path = tempfile.mkstemp(dir=cogs_dir, suffix=".tsv")
+    width = 0
+    length = 0
+    try:
+        with os.fdopen(fd, "w") as f:
+            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+            for data in windows:
+                idx_y = data.get("startRow", 0)
+                for row in data.get("rowData", []):
+                    idx_y += 1
+                    if not row:
+                        # Empty row
+                        continue
+                    idx_x = 0
+                    row_values = []
+                    format_runs = []
+                    dv_runs = []
+                    for cell in row.get("values", []):
+                        idx_x += 1
+                        row_values.append(cell.get("formattedValue", ""))
+                        label = gspread.utils.rowcol_to_a1(idx_y, idx_x)
+
+                        if "note" in cell:
+                            cell_to_note[label] = cell["note"].replace("\n", "\\n")
+
+                        if "dataValidation" in cell:
+                            condition = cell["dataValidation"]["condition"]
+                            bc = gf.BooleanCondition(condition["type"], condition.get("values", []))
+                            dv = gf.DataValidationRule(bc)
+                            if str(dv) not in str_to_rule:
+                                str_to_rule[str(dv)] = dv
+                            add_to_runs(dv_runs, idx_x, str(dv))
+
+                        fmt = cell.get("userEnteredFormat")
+                        if fmt:
+                            add_to_runs(format_runs, idx_x, json.dumps(fmt, sort_keys=True))
+
+                    add_row_runs(open_format_ranges, format_ranges, idx_y, format_runs)
+                    add_row_runs(open_dv_ranges, dv_ranges, idx_y, dv_runs)
+
+                    # Write the row (and any empty rows before it) if it has a value
+                    while row_values and row_values[-1] == "":
+                        row_values.pop()
+                    if not row_values:
+                        continue
+                    writer.writerows([[]] * (idx_y - length - 1))
+                    writer.writerow(row_values)
+                    width = max(width, len(row_values))
+                    length = idx_y
+
+        # Create a cell or range to format dict from the rectangles
+        close_ranges(open_format_ranges, format_ranges)
+        cell_to_format_key = get_a1_ranges(format_ranges)
+
+        # Aggregate by location and format for validate.tsv
+        close_ranges(open_dv_ranges, dv_ranges)
+        dv_rows = clean_data_validation_rules(dv_ranges, str_to_rule)
+
+        # Write values to .cogs/tracked/{sheet title}.tsv with each row padded to the same width
+        # These come from the same response as the formats, notes, and data validation
+        # If the values have not changed, the cached copy is left alone
+        cached_path = get_cached_path(cogs_dir, sheet_title)
+        new_values_hash = get_hash(get_padded_rows(part_path, width))
+        if new_values_hash != values_hash or not os.path.exists(cached_path):
+            with open(cached_path, "w") as f:
+                writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+                writer.writerows(get_padded_rows(part_path, width))
+        else:
+            logging.info(f"Values of sheet '{sheet_title}' have not changed")
+    finally:
+        os.remove(part_path)
+
+    return {
+        "formats": cell_to_format_key,
+        "notes": cell_to_note,
+        "data_validation": dv_rows,
+        "values_hash": new_values_hash,
+    }
+
+
+def process_sheets(cogs_dir, session, spreadsheet, sheets, fields, values_hashes, jobs=1):
+    """Download and process the cell data (values, formatting, notes, and data validation) of the
+    remote sheets (map of sheet title -> remote sheet) using up to 'jobs' threads. Sheets with up
+    to WINDOW_CELLS cells are requested in as few spreadsheets.get calls as possible, and each
+    batch is processed as soon as it arrives, so only 'jobs' responses are held in memory at a
+    time. Larger sheets are requested one window at a time as they are processed. Return a map of
+    sheet title -> details from process_sheet, in the order of the sheets."""
+    batch_sheets = []
+    window_sheets = {}
+    titles = {}
+    for sheet_title, sheet in sheets.items():
+        titles[sheet.title] = sheet_title
+        if sheet.row_count * sheet.col_count > WINDOW_CELLS:
+            window_sheets[sheet_title] = sheet
+        else:
+            batch_sheets.append(sheet)
+
+    sheet_details = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for batch in get_batches(batch_sheets, jobs=jobs):
+            futures.append(
+                executor.submit(
+                    process_batch,
+                    cogs_dir,
+                    session,
+                    spreadsheet.id,
+                    {titles[sheet.title]: sheet for sheet in batch},
+                    fields,
+                    values_hashes,
+                )
+            )
+        window_futures = {}
+        for sheet_title, sheet in window_sheets.items():
+            window_futures[sheet_title] = executor.submit(
+                process_sheet,
+                cogs_dir,
+                sheet_title,
+                get_windows(session, spreadsheet.id, sheet, fields),
+                values_hashes.get(sheet_title),
+            )
+        for future in as_completed(futures):
+            sheet_details.update(future.result())
+        for sheet_title, future in window_futures.items():
+            sheet_details[sheet_title] = future.result()
+    return {sheet_title: sheet_details[sheet_title] for sheet_title in sheets}
+
+
 def remove_sheets(cogs_dir, sheets, tracked_sheets, renamed_local, renamed_remote):
     """Remove tracked sheets that are no longer in the remote spreadsheet.
     Return the titles of these sheets."""
@@ -225,13 +415,32 @@ def remove_sheets(cogs_dir, sheets, tracked_sheets, renamed_local, renamed_remot
     return remove_from_sheet
 
 
-def fetch(verbose=False):
-    """Fetch all sheets from project spreadsheet to .cogs/ directory."""
+def fetch(jobs=1, force=False, verbose=False):
+    """Fetch all sheets from project spreadsheet to .cogs/ directory. Up to 'jobs' sheets are
+    downloaded and processed concurrently. Unless 'force' is used, nothing is downloaded when
+    the spreadsheet and the COGS configuration have not changed since the last fetch."""
     set_logging(verbose)
     cogs_dir = validate_cogs_project()
+    if jobs < 1:
+        raise FetchError(f"the number of jobs must be at least 1 (got {jobs})")
 
     config = get_config(cogs_dir)
-    gc = get_client_from_config(config)
+    session = get_session(config)
+    gc = session.client
+
+    # Check the version of the spreadsheet before downloading anything
+    # This is retrieved first so that any changes made during the fetch are picked up next time
+    remote_version = get_remote_version(gc, config["Spreadsheet ID"])
+    if remote_version and not force:
+        state = get_fetch_state(cogs_dir)
+        if (
+            state.get("Modified Time") == remote_version["Modified Time"]
+            and state.get("Version") == remote_version["Version"]
+            and state.get("Metadata") == get_metadata_hash(cogs_dir)
+        ):
+            logging.info("Spreadsheet has not changed since the last fetch")
+            return
+
     spreadsheet = gc.open_by_key(config["Spreadsheet ID"])
 
     # Get the remote sheets from spreadsheet
@@ -271,6 +480,9 @@ def fetch(verbose=False):
     # Lines to add to sheet.tsv of sheets to ignore
     new_ignore = []
 
+    # Sheets to download as sheet title -> remote sheet
+    download_sheets = {}
+
     for sheet in sheets:
         remote_title = sheet.title
         if remote_title in tracked_sheets and tracked_sheets[remote_title].get("Ignore"):
@@ -313,68 +525,29 @@ def fetch(verbose=False):
             "row": sheet.frozen_row_count,
             "col": sheet.frozen_col_count,
         }
+        download_sheets[st] = sheet
+
+    # Fingerprints of the previously fetched sheets, used to only rewrite what has changed
+    fingerprints = get_fingerprints(cogs_dir)
+
+    # Download the cells with format, value, and note from all remote sheets and process each sheet
+    # (collapse formats, write TSV) in the worker pool
+    sheet_details = process_sheets(
+        cogs_dir,
+        session,
+        spreadsheet,
+        download_sheets,
+        get_fields(config),
+        {st: fingerprints.get(st, {}).get("Values") for st in download_sheets},
+        jobs=jobs,
+    )
 
-        # Get the cells with format, value, and note from remote sheet
-        cells = get_cell_data(cogs_dir, sheet)
-
-        # Create a map of rule -> locs for data validation
-        dv_rules = {}
-        str_to_rule = {}
-        for loc, cell_data in cells.items():
-            if "data_validation" not in cell_data:
-                continue
-            data_validation = cell_data["data_validation"]
-            condition = data_validation["condition"]
-            bc = gf.BooleanCondition(condition, data_validation["value"])
-            dv = gf.DataValidationRule(bc)
-            if str(dv) not in str_to_rule:
-                str_to_rule[str(dv)] = dv
-            if str(dv) in dv_rules:
-                locs = dv_rules[str(dv)]
-            else:
-                locs = []
-            locs.append(loc)
-            dv_rules[str(dv)] = locs
-
-        # Aggregate by location and format for validate.tsv
-        dv_rows = clean_data_validation_rules(dv_rules, str_to_rule)
-        sheet_dv_rules[st] = dv_rows
-
-        # Get the ending row & col that have values
-        # Otherwise we end up with a bunch of empty rows/columns
-        # Also get the data validation
-        max_row = 0
-        max_col = 0
-
-        for c in cells.keys():
-            row, col = gspread.utils.a1_to_rowcol(c)
-            if row > max_row:
-                max_row = row
-            if col > max_col:
-                max_col = col
-
-        # Cell label to format dict
-        cell_to_format = {cell: data["format"] for cell, data in cells.items() if "format" in data}
-
-        # Create a cell to format ID dict based on the format dict for each cell
+    # Assign format IDs to the formats of each sheet in sheet order so that IDs are stable
+    first_new_fmt_id = next_fmt_id
+    new_fingerprints = {}
+    for st, details in sheet_details.items():
         cell_to_format_id = {}
-        last_fmt = None
-        cell_range_start = None
-        cell_range_end = None
-        for cell, fmt in cell_to_format.items():
-            if not fmt:
-                if last_fmt:
-                    if not cell_range_end or cell_range_start == cell_range_end:
-                        cell_to_format_id[cell_range_start] = last_fmt
-                    else:
-                        cell_to_format_id[f"{cell_range_start}:{cell_range_end}"] = last_fmt
-                last_fmt = None
-                cell_range_start = None
-                cell_range_end = None
-                continue
-
-            key = json.dumps(fmt, sort_keys=True)
-
+        for cell, key in details["formats"].items():
             if key in format_to_id:
                 # Format already exists, assign that ID
                 fmt_id = format_to_id[key]
@@ -382,54 +555,27 @@ def fetch(verbose=False):
                 # Assign new ID
                 fmt_id = next_fmt_id
                 format_to_id[key] = fmt_id
-                id_to_format[fmt_id] = fmt
+                id_to_format[fmt_id] = json.loads(key)
                 next_fmt_id += 1
-
-            if last_fmt and fmt_id == last_fmt:
-                # The last cell had a format and the this cell's format is the same as the last
-                # so we increase the range
-                cell_range_end = cell
-            elif last_fmt and fmt_id != last_fmt:
-                # The last cell had a format but it was different than the current format
-                if cell_range_start == cell_range_end or not cell_range_end:
-                    # Not a range, just a single cell (the previous cell)
-                    cell_to_format_id[cell_range_start] = last_fmt
-                else:
-                    cell_to_format_id[f"{cell_range_start}:{cell_range_end}"] = last_fmt
-                # Restarting a new range at this cell
-                cell_range_start = cell
-                cell_range_end = None
-            else:
-                # No last formatting to compare to, start a new range
-                cell_range_start = cell
-                cell_range_end = cell
-            last_fmt = fmt_id
-
-        # Get the last format
-        if last_fmt:
-            if not cell_range_end or cell_range_start == cell_range_end:
-                cell_to_format_id[cell_range_start] = last_fmt
-            else:
-                cell_to_format_id[f"{cell_range_start}:{cell_range_end}"] = last_fmt
-
+            cell_to_format_id[cell] = fmt_id
         if cell_to_format_id:
             sheet_formats[st] = cell_to_format_id
-
-        # Add the cell to note
-        cell_to_note = {cell: data["note"] for cell, data in cells.items() if "note" in data}
-        if cell_to_note:
-            sheet_notes[st] = cell_to_note
-
-        # Write values to .cogs/tracked/{sheet title}.tsv
-        cached_path = get_cached_path(cogs_dir, st)
-        with open(cached_path, "w") as f:
-            lines = sheet.get_all_values()
-            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
-            writer.writerows(lines)
+        if details["notes"]:
+            sheet_notes[st] = details["notes"]
+        sheet_dv_rules[st] = details["data_validation"]
+
+        new_fingerprints[st] = {"Values": details["values_hash"]}
+        new_fingerprints[st].update(
+            get_sheet_hashes(cell_to_format_id, details["notes"], details["data_validation"])
+        )
+        new_fingerprints[st]["Properties"] = get_properties_hash(
+            sheet_frozen[st]["row"], sheet_frozen[st]["col"]
+        )
 
     # Write or rewrite formats JSON with new dict
-    with open(f"{cogs_dir}/formats.json", "w") as f:
-        f.write(json.dumps(id_to_format, sort_keys=True, indent=4))
+    if next_fmt_id != first_new_fmt_id or not os.path.exists(f"{cogs_dir}/formats.json"):
+        with open(f"{cogs_dir}/formats.json", "w") as f:
+            f.write(json.dumps(id_to_format, sort_keys=True, indent=4))
 
     # Update local sheets details in sheet.tsv with new IDs & details for current tracked sheets
     all_sheets = get_updated_sheet_details(tracked_sheets, remote_sheets, sheet_frozen)
@@ -444,13 +590,32 @@ def fetch(verbose=False):
             f.write(f"{old_title}\t{new_title}\t{new_path}\tremote\n")
 
     # Rewrite format.tsv and note.tsv with current remote formats & notes
-    update_format(cogs_dir, sheet_formats, removed_titles, overwrite=True)
-    update_note(cogs_dir, sheet_notes, removed_titles, overwrite=True)
+    # These are only rewritten if the fingerprint of a sheet has changed
+    if fingerprints_changed(cogs_dir, fingerprints, new_fingerprints, "Formats", "format.tsv"):
+        update_format(cogs_dir, sheet_formats, removed_titles, overwrite=True)
+    if fingerprints_changed(cogs_dir, fingerprints, new_fingerprints, "Notes", "note.tsv"):
+        update_note(cogs_dir, sheet_notes, removed_titles, overwrite=True)
     # Remove old data validation rules and rewrite with new
-    with open(f"{cogs_dir}/validation.tsv", "w") as f:
-        f.write("Sheet\tRange\tCondition\tValue\n")
-    update_data_validation(cogs_dir, sheet_dv_rules, removed_titles)
+    if fingerprints_changed(
+        cogs_dir, fingerprints, new_fingerprints, "Validation", "validation.tsv"
+    ):
+        with open(f"{cogs_dir}/validation.tsv", "w") as f:
+            f.write("Sheet\tRange\tCondition\tValue\n")
+        update_data_validation(cogs_dir, sheet_dv_rules, removed_titles)
+
+    # Record the fingerprints of the fetched sheets
+    # This is written after the files above so that local edits to those files can be detected
+    update_fingerprints(cogs_dir, new_fingerprints)
 
     # Then update sheet.tsv
     all_sheets.extend(new_ignore)
     update_sheet(cogs_dir, all_sheets, removed_titles)
+
+    # Finally, record the version of the spreadsheet that was fetched
+    # The cached sheets now match this version, so the next push can be incremental
+    if remote_version:
+        remote_version["Metadata"] = get_metadata_hash(cogs_dir)
+        remote_version["Synced Version"] = remote_version["Version"]
+        update_fetch_state(cogs_dir, remote_version)
+
+    logging.info(session.scheduler.get_summary())
@@ -1,17 +1,32 @@
 import csv
 import datetime
+import difflib
+import email.utils
 import google.auth.exceptions
 import gspread
+import gspread.utils
+import hashlib
+import httplib2
+import inspect
 import json
 import logging
 import os
 import pkg_resources
+import random
 import re
+import tempfile
+import threading
+import time
 
+from concurrent.futures import ProcessPoolExecutor
 from cogs.exceptions import CogsError
 from daff import Coopy, CompareFlags, PythonTableView, TableDiff
 from google.oauth2.service_account import Credentials
-
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient import discovery
+from googleapiclient.discovery_cache.base import Cache
+from googleapiclient.errors import HttpError
+from gspread.urls import DRIVE_FILES_API_V3_URL
 
 required_files = [
     "config.tsv",
@@ -20,19 +35,326 @@ required_files = [
     "sheet.tsv",
     "validation.tsv",
 ]
-optional_files = ["user.tsv", "renamed.tsv"]
+optional_files = ["user.tsv", "renamed.tsv", "remote.tsv", "fingerprint.tsv", "index.tsv"]
+
+# Files in the COGS directory that determine what is fetched and how it is stored
+metadata_files = [
+    "formats.json",
+    "format.tsv",
+    "note.tsv",
+    "renamed.tsv",
+    "sheet.tsv",
+    "validation.tsv",
+]
 
 required_keys = ["Spreadsheet ID", "Title"]
 
+# Increase to invalidate the discovery documents cached by previous versions of COGS
+DISCOVERY_CACHE_VERSION = 1
+
+# Cached discovery documents are downloaded again after this many seconds
+DISCOVERY_CACHE_MAX_AGE = 86400
+
+# Cached access tokens are only used if they are valid for at least this many more seconds
+TOKEN_EXPIRY_MARGIN = 300
+# Format of the expiry time (UTC) of cached access tokens
+TOKEN_EXPIRY_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# Default per-minute quotas of read and write requests for the Google Sheets API (per user)
+# These can be changed with the "Read Requests Per Minute" and "Write Requests Per Minute" keys
+# in config.tsv for projects with a higher quota
+READ_REQUESTS_PER_MINUTE = 60
+WRITE_REQUESTS_PER_MINUTE = 60
+
+# Number of times a request is retried after a 429 or 5xx response, and the maximum number of
+# seconds to wait between retries (before jitter)
+MAX_RETRIES = 6
+MAX_BACKOFF = 64
+
+# Requests for spreadsheets.batchUpdate that have the same result when they are sent twice
+# Other requests (e.g., inserting or deleting rows) are not retried after a 5xx response, as the
+# server may have applied them before failing
+IDEMPOTENT_REQUESTS = {
+    "repeatCell",
+    "setDataValidation",
+    "updateCells",
+    "updateDimensionProperties",
+    "updateSheetProperties",
+    "updateSpreadsheetProperties",
+}
+
 credential_keys = []
 
 
+class DiscoveryCache(Cache):
+    """Cache of API discovery documents, kept in memory and in the COGS cache directory (see
+    get_cache_dir) so that each COGS command does not need to download the document again. The
+    documents are keyed by URL, DISCOVERY_CACHE_VERSION, and the version of
+    google-api-python-client, and expire after DISCOVERY_CACHE_MAX_AGE seconds."""
+
+    _CACHE = {}
+
+    def get_path(self, url):
+        try:
+            client_version = pkg_resources.get_distribution("google-api-python-client").version
+        except pkg_resources.DistributionNotFound:
+            client_version = ""
+        key = f"{DISCOVERY_CACHE_VERSION} {client_version} {url}"
+        return os.path.join(
+            get_cache_dir(), "discovery", hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json"
+        )
+
+    def get(self, url):
+        if url in DiscoveryCache._CACHE:
+            return DiscoveryCache._CACHE[url]
+        path = self.get_path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > DISCOVERY_CACHE_MAX_AGE:
+                return None
+            with open(path, "r") as f:
+                content = f.read()
+        except OSError:
+            return None
+        DiscoveryCache._CACHE[url] = content
+        return content
+
+    def set(self, url, content):
+        DiscoveryCache._CACHE[url] = content
+        path = self.get_path(url)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so that other commands never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.debug(f"Unable to cache discovery document at {path}: {str(e)}")
+
+
+class TokenBucket:
+    """A thread-safe token bucket that allows 'rate' requests per second on average, with bursts
+    of up to 'capacity' requests."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token from the bucket, waiting until one is available. Return the number of
+        seconds spent waiting."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token now; if the bucket is empty, wait until it has been refilled
+            self.tokens -= 1
+            wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RequestScheduler:
+    """Sends the requests of a COGS command to the Google APIs. Read and write requests each have
+    a token bucket matched to the per-minute quota, and requests that fail with a 429 or 5xx
+    response are retried with jittered exponential backoff, honouring Retry-After. The metrics
+    count the requests, the retries, and the seconds spent throttled."""
+
+    def __init__(
+        self,
+        reads_per_minute=READ_REQUESTS_PER_MINUTE,
+        writes_per_minute=WRITE_REQUESTS_PER_MINUTE,
+        max_retries=MAX_RETRIES,
+    ):
+        # Bursts are limited to a tenth of the quota so that no one minute exceeds it by much
+        self.buckets = {
+            "read": TokenBucket(reads_per_minute / 60, max(1, reads_per_minute // 10)),
+            "write": TokenBucket(writes_per_minute / 60, max(1, writes_per_minute // 10)),
+        }
+        self.max_retries = max_retries
+        self.metrics = {"requests": 0, "retries": 0, "throttled": 0.0}
+        self._lock = threading.Lock()
+
+    def add_metrics(self, **kwargs):
+        with self._lock:
+            for key, value in kwargs.items():
+                self.metrics[key] += value
+
+    def call(self, kind, send, idempotent=True):
+        """Send a request (a function with no arguments that sends the request and returns the
+        response) of the given kind (read or write) and return the response. The request waits
+        for its token bucket and is retried if it fails with a 429 response, or with a 5xx response
+        if it is idempotent (see is_idempotent)."""
+        attempt = 0
+        while True:
+            waited = self.buckets[kind].acquire()
+            self.add_metrics(requests=1, throttled=waited)
+            try:
+                return send()
+            except (gspread.exceptions.APIError, HttpError) as e:
+                status, retry_after = get_retry_details(e)
+                retry = status == 429 or (status >= 500 and idempotent)
+                if attempt >= self.max_retries or not retry:
+                    raise
+                delay = retry_after
+                if delay is None:
+                    delay = min(MAX_BACKOFF, 2**attempt) + random.random()
+                logging.info(f"Request failed with status {status}; retrying in {delay:.1f}s")
+                time.sleep(delay)
+                self.add_metrics(retries=1, throttled=delay)
+                attempt += 1
+
+    def get_summary(self):
+        """Return a summary of the metrics as a string."""
+        return (
+            f"Sent {self.metrics['requests']} request(s) with {self.metrics['retries']} "
+            f"retries; {self.metrics['throttled']:.1f}s spent throttled"
+        )
+
+
+class ScheduledClient(gspread.Client):
+    """A gspread Client that sends all requests through a RequestScheduler."""
+
+    def __init__(self, auth, scheduler=None):
+        super().__init__(auth)
+        self.scheduler = scheduler or RequestScheduler()
+
+    def request(self, method, endpoint, *args, **kwargs):
+        kind = "read" if method.lower() == "get" else "write"
+        return self.scheduler.call(
+            kind,
+            lambda: super(ScheduledClient, self).request(method, endpoint, *args, **kwargs),
+            idempotent=is_idempotent(method, endpoint, kwargs.get("json")),
+        )
+
+
+class Session:
+    """The Google credentials, gspread Client, and Sheets API service used by one COGS command.
+    The credentials are loaded once, and the Client and service are created once when they are
+    first used, so everything the command does shares the same access token."""
+
+    def __init__(self, credentials_path=None, scheduler=None):
+        self.credentials = get_credentials(credentials_path=credentials_path)
+        self.scheduler = scheduler or RequestScheduler()
+        self._client = None
+        self._service = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """The gspread Client. This uses one requests session, so connections are kept alive."""
+        with self._lock:
+            if not self._client:
+                self._client = get_client(gcred=self.credentials, scheduler=self.scheduler)
+            return self._client
+
+    @property
+    def service(self):
+        """The Sheets API service, used to build requests to send with execute."""
+        with self._lock:
+            if not self._service:
+                kwargs = {}
+                if "static_discovery" in inspect.signature(discovery.build).parameters:
+                    # Use the discovery document bundled with google-api-python-client >= 2.0
+                    kwargs["static_discovery"] = True
+                self._service = discovery.build(
+                    "sheets", "v4", credentials=self.credentials, cache=DiscoveryCache(), **kwargs
+                )
+            return self._service
+
+    def execute(self, request):
+        """Execute a Sheets API request through the scheduler, over the authorized HTTP transport
+        of the current thread. The transport keeps its connections alive between requests; each
+        thread has its own, as httplib2 is not thread-safe."""
+        if not hasattr(self._local, "http"):
+            self._local.http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+        kind = "read" if request.method == "GET" else "write"
+        idempotent = True
+        if kind == "write":
+            body = json.loads(request.body) if request.body else None
+            idempotent = is_idempotent(request.method, request.uri, body)
+        return self.scheduler.call(
+            kind, lambda: request.execute(http=self._local.http), idempotent=idempotent
+        )
+
+
+def add_row_runs(open_ranges, ranges, row, runs, end_row=None):
+    """Merge the runs of a row (1-based) into rectangles of cells with the same key (e.g., a
+    format). Runs are (start column, end column, key) for consecutive cells with the same key.
+    Each run extends the open rectangle with the same columns and key that ends on the previous
+    row; otherwise it starts a new rectangle. Rectangles that are not extended are closed and
+    added to ranges as (start row, start column, end row, end column, key). Rows must be added in
+    order, but empty rows do not need to be added. If end_row is given, all rows from row to
+    end_row have the same runs."""
+    if not end_row:
+        end_row = row
+    still_open = {}
+    for start_col, end_col, key in runs:
+        rect = open_ranges.pop((start_col, end_col, key), None)
+        if rect and rect[1] == row - 1:
+            still_open[(start_col, end_col, key)] = (rect[0], end_row)
+        else:
+            if rect:
+                ranges.append((rect[0], start_col, rect[1], end_col, key))
+            still_open[(start_col, end_col, key)] = (row, end_row)
+    close_ranges(open_ranges, ranges)
+    open_ranges.update(still_open)
+
+
+def add_to_runs(runs, col, key):
+    """Add a cell (1-based column) with the given key to the runs of a row. Cells must be added
+    in order. If the previous cell has the same key, its run is extended."""
+    if runs and runs[-1][1] == col - 1 and runs[-1][2] == key:
+        runs[-1] = (runs[-1][0], col, key)
+    else:
+        runs.append((col, col, key))
+
+
+def close_ranges(open_ranges, ranges):
+    """Close all open rectangles and add them to ranges."""
+    for (start_col, end_col, key), (start_row, end_row) in open_ranges.items():
+        ranges.append((start_row, start_col, end_row, end_col, key))
+    open_ranges.clear()
+
+
+def get_cache_dir():
+    """Return the path to the COGS cache directory for the current user. This is 'cogs' in
+    XDG_CACHE_HOME, or ~/.cache/cogs by default. The directory may not exist yet."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "cogs")
+
+
 def get_cached_path(cogs_dir, sheet_title):
     """Return the path to the cached version of a sheet based on its title."""
     filename = re.sub(r"[^A-Za-z0-9]+", "_", sheet_title.lower())
     return f"{cogs_dir}/tracked/{filename}.tsv"
 
 
+def get_cached_token(gcred):
+    """If the token cache is enabled (see get_token_cache_path), add the cached access token for
+    these credentials to the Credentials object when it is valid for at least another
+    TOKEN_EXPIRY_MARGIN seconds."""
+    path = get_token_cache_path(gcred)
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path, "r") as f:
+            cached = json.load(f)
+        expiry = datetime.datetime.strptime(cached["expiry"], TOKEN_EXPIRY_FORMAT)
+    except (OSError, ValueError, KeyError) as e:
+        logging.debug(f"Unable to read cached access token from {path}: {str(e)}")
+        return
+    if expiry - datetime.datetime.utcnow() > datetime.timedelta(seconds=TOKEN_EXPIRY_MARGIN):
+        logging.info("Using cached access token")
+        gcred.token = cached["token"]
+        gcred.expiry = expiry
+
+
 def get_cached_sheets(cogs_dir):
     """Return a list of names of cached sheets from .cogs/tracked. These are any sheets that have
     been downloaded from the remote spreadsheet into the .cogs directory as TSVs. They may or may
@@ -77,17 +399,24 @@ def get_credentials(credentials_path=None):
     except ValueError as ve:
         # credentials are missing a required key
         raise CogsError(f"Unable to create a Client from credentials; {str(ve)}")
+    get_cached_token(gcred)
     return gcred
 
 
-def get_client(credentials_path=None):
-    """Get the google.auth Client to perform Google Sheets API actions."""
+def get_client(credentials_path=None, gcred=None, scheduler=None):
+    """Get the google.auth Client to perform Google Sheets API actions. If a Credentials object is
+    not provided, the credentials are loaded from credentials_path (or the environment). All
+    requests are sent through the scheduler (or a new RequestScheduler)."""
     # First get the credentials JSON
-    gcred = get_credentials(credentials_path=credentials_path)
+    if not gcred:
+        gcred = get_credentials(credentials_path=credentials_path)
     try:
         # Create gspread Client & log in
-        gc = gspread.Client(auth=gcred)
-        gc.login()
+        gc = ScheduledClient(gcred, scheduler=scheduler)
+        if not gcred.valid:
+            # No access token yet (or it has expired)
+            gc.login()
+            update_cached_token(gcred)
         return gc
 
     except gspread.exceptions.APIError as e:
@@ -107,6 +436,20 @@ def get_client_from_config(config):
         return get_client()
 
 
+def get_session(config):
+    """Get the Session for a COGS command from COGS configuration."""
+    try:
+        scheduler = RequestScheduler(
+            reads_per_minute=int(config.get("Read Requests Per Minute", READ_REQUESTS_PER_MINUTE)),
+            writes_per_minute=int(
+                config.get("Write Requests Per Minute", WRITE_REQUESTS_PER_MINUTE)
+            ),
+        )
+    except ValueError as e:
+        raise CogsError(f"Requests per minute in COGS configuration must be a number; {str(e)}")
+    return Session(credentials_path=config.get("Credentials"), scheduler=scheduler)
+
+
 def get_config(cogs_dir):
     """Get the configuration for this project as a dict."""
     config = {}
@@ -141,7 +484,7 @@ def get_data_validation(cogs_dir):
     return sheet_to_dv_rules
 
 
-def get_diff(left, right):
+def get_diff(left, right, keys=None):
     """Return the diff between a left (old) and right (new) sheet as a list of lines (list of cell
     values) with daff 'highlighter' formatting. The 'highlight' is appended to the beginning of the
     line as:
@@ -149,48 +492,20 @@ def get_diff(left, right):
     - '->' for changed lines
     - '...' for omitted rows
     - '---' for removed lines
-    - '' for unchanged lines"""
-    left_data = []
-    with open(left, "r") as f:
-        if left.endswith("csv"):
-            reader = csv.reader(f)
-        else:
-            reader = csv.reader(f, delimiter="\t")
-        try:
-            header = next(reader)
-        except StopIteration:
-            # No data
-            header = None
-        if header:
-            left_data.append(header)
-            for row in reader:
-                if len(row) < len(header):
-                    add = [""] * (len(header) - len(row))
-                    row.extend(add)
-                left_data.append(row)
-
-    right_data = []
-    with open(right, "r") as f:
-        if right.endswith("csv"):
-            reader = csv.reader(f)
-        else:
-            reader = csv.reader(f, delimiter="\t")
-        try:
-            header = next(reader)
-        except StopIteration:
-            # No data
-            header = None
-        if header:
-            right_data.append(header)
-            for row in reader:
-                if len(row) < len(header):
-                    add = [""] * (len(header) - len(row))
-                    row.extend(add)
-                right_data.append(row)
-
+    - '' for unchanged lines
+    If key columns are provided, rows are aligned by their keys (see get_keyed_diff). Otherwise,
+    or if the keys are missing or not unique in either sheet, rows are aligned by daff."""
+    left_data = get_table_data(left)
+    right_data = get_table_data(right)
     if not right_data and not left_data:
         return []
 
+    if keys:
+        data_diff = get_keyed_diff(left_data, right_data, keys)
+        if data_diff is not None:
+            return data_diff
+        logging.info(f"Cannot diff {right} by key columns {', '.join(keys)}; using daff")
+
     right_table = PythonTableView(right_data)
     left_table = PythonTableView(left_data)
     align = Coopy.compareTables(left_table, right_table).align()
@@ -204,6 +519,270 @@ def get_diff(left, right):
     return data_diff
 
 
+def get_diff_summary(left, right, keys=None):
+    """Return a summary of the diff between a left (old) and right (new) sheet as a dict of the
+    number of added_cols, removed_cols, added_lines, removed_lines, and changed_lines. Unlike
+    get_diff, the rows are never aligned or highlighted: each row is reduced to the hash of its
+    values in the columns that are in both sheets, and the hashes of the old and new rows are
+    compared as multisets. If key columns are provided, an added and a removed row with the same
+    key are counted as a changed row. Otherwise, as many added and removed rows as possible are
+    paired up as changed rows."""
+    left_file = open(left, "r")
+    right_file = open(right, "r")
+    try:
+        readers = []
+        for path, f in [(left, left_file), (right, right_file)]:
+            if path.endswith("csv"):
+                readers.append(csv.reader(f))
+            else:
+                readers.append(csv.reader(f, delimiter="\t"))
+        left_reader, right_reader = readers
+        left_headers = next(left_reader, [])
+        right_headers = next(right_reader, [])
+        common = [h for h in left_headers if h in right_headers]
+        summary = {
+            "added_cols": len([h for h in right_headers if h not in left_headers]),
+            "removed_cols": len([h for h in left_headers if h not in right_headers]),
+            "added_lines": 0,
+            "removed_lines": 0,
+            "changed_lines": 0,
+        }
+        if keys and any(k not in common for k in keys):
+            keys = None
+
+        left_cols = [left_headers.index(h) for h in common]
+        right_cols = [right_headers.index(h) for h in common]
+        left_keys = [left_headers.index(k) for k in keys or []]
+        right_keys = [right_headers.index(k) for k in keys or []]
+
+        # Count the old rows by hash (and, with keys, the keys of the rows with each hash)
+        left_rows = {}
+        for row in left_reader:
+            if not common:
+                summary["removed_lines"] += 1
+                continue
+            row_hash = hash(tuple(row[c] if c < len(row) else "" for c in left_cols))
+            if keys:
+                key = tuple(row[k] if k < len(row) else "" for k in left_keys)
+                left_rows.setdefault(row_hash, []).append(key)
+            else:
+                left_rows[row_hash] = left_rows.get(row_hash, 0) + 1
+
+        # Remove the new rows that match an old row, keeping the keys of the added rows
+        added_keys = []
+        for row in right_reader:
+            if not common:
+                summary["added_lines"] += 1
+                continue
+            row_hash = hash(tuple(row[c] if c < len(row) else "" for c in right_cols))
+            if keys:
+                key = tuple(row[k] if k < len(row) else "" for k in right_keys)
+                matches = left_rows.get(row_hash)
+                if matches and key in matches:
+                    matches.remove(key)
+                else:
+                    added_keys.append(key)
+            elif left_rows.get(row_hash):
+                left_rows[row_hash] -= 1
+            else:
+                summary["added_lines"] += 1
+    finally:
+        left_file.close()
+        right_file.close()
+
+    if keys:
+        removed_keys = {}
+        for row_keys in left_rows.values():
+            for key in row_keys:
+                removed_keys[key] = removed_keys.get(key, 0) + 1
+        for key in added_keys:
+            if removed_keys.get(key):
+                removed_keys[key] -= 1
+                summary["changed_lines"] += 1
+            else:
+                summary["added_lines"] += 1
+        summary["removed_lines"] += sum(removed_keys.values())
+    elif common:
+        removed_lines = sum(left_rows.values())
+        changed_lines = min(removed_lines, summary["added_lines"])
+        summary["changed_lines"] = changed_lines
+        summary["added_lines"] -= changed_lines
+        summary["removed_lines"] = removed_lines - changed_lines
+    return summary
+
+
+def get_keyed_diff(left_data, right_data, keys):
+    """Return the diff between a left (old) and right (new) table (list of rows, starting with the
+    headers) in the same format as get_diff. Rows are aligned by the values of the key columns
+    instead of by daff, so each table is only read through once. Unchanged rows are found by
+    comparing the hashes of the rows before comparing any cells. Rows that have only moved are not
+    reported. Return None if either table is missing a key column or has duplicate keys."""
+    if not left_data or not right_data:
+        return None
+    left_headers = left_data[0]
+    right_headers = right_data[0]
+    if any(k not in left_headers or k not in right_headers for k in keys):
+        return None
+
+    # Columns of the diff: the new columns, with any removed columns after the column they followed
+    headers = list(right_headers)
+    prev = None
+    for h in left_headers:
+        if h not in right_headers:
+            headers.insert(headers.index(prev) + 1 if prev else 0, h)
+        prev = h
+    common = [h for h in left_headers if h in right_headers]
+    # Columns in both tables that are not in the longest run of columns in the same order have moved
+    right_common = [h for h in right_headers if h in left_headers]
+    matcher = difflib.SequenceMatcher(None, right_common, common, autojunk=False)
+    moved = set(right_common)
+    for block in matcher.get_matching_blocks():
+        moved -= set(right_common[block.a : block.a + block.size])
+    col_changes = len(common) != len(left_headers) or len(common) != len(right_headers)
+    col_changes = col_changes or bool(moved)
+    added_idx = [right_headers.index(h) for h in right_headers if h not in left_headers]
+    left_idx = [left_headers.index(h) if h in left_headers else None for h in headers]
+    right_idx = [right_headers.index(h) if h in right_headers else None for h in headers]
+    left_common = [left_headers.index(h) for h in common]
+    right_common = [right_headers.index(h) for h in common]
+    left_keys = [left_headers.index(k) for k in keys]
+    right_keys = [right_headers.index(k) for k in keys]
+
+    # Index the old rows by key -> (position, hash of the values in common columns)
+    left_rows = {}
+    for i, row in enumerate(left_data[1:]):
+        key = tuple(row[k] for k in left_keys)
+        if key in left_rows:
+            return None
+        left_rows[key] = (i, hash(tuple(row[c] for c in left_common)))
+
+    # Align the new rows with the old rows, keeping removed rows where they were in the old table
+    lines = []
+    right_keys_seen = set()
+    pos = 0
+    for row in right_data[1:]:
+        key = tuple(row[k] for k in right_keys)
+        if key in right_keys_seen:
+            return None
+        right_keys_seen.add(key)
+        if key not in left_rows:
+            lines.append(("+++", None, row))
+            continue
+        i, row_hash = left_rows[key]
+        if i >= pos:
+            lines.extend(("---", j, None) for j in range(pos, i))
+            pos = i + 1
+        if row_hash != hash(tuple(row[c] for c in right_common)):
+            lines.append(("->", i, row))
+        elif any(row[c] for c in added_idx):
+            # The row only has new values in the added columns
+            lines.append(("+", i, row))
+        else:
+            lines.append(("", i, row))
+    lines.extend(("---", j, None) for j in range(pos, len(left_data) - 1))
+    # Old rows that were skipped over by a moved row may still exist in the new table
+    lines = [
+        line
+        for line in lines
+        if line[0] != "---"
+        or tuple(left_data[line[1] + 1][k] for k in left_keys) not in right_keys_seen
+    ]
+
+    data_diff = []
+    if col_changes:
+        col_actions = ["!"]
+        for h in headers:
+            if h not in left_headers:
+                col_actions.append("+++")
+            elif h not in right_headers:
+                col_actions.append("---")
+            elif h in moved:
+                col_actions.append(":")
+            else:
+                col_actions.append("")
+        data_diff.append(col_actions)
+    data_diff.append(["@@"] + headers)
+
+    changed = [action != "" for action, _, _ in lines]
+    for n, (action, i, row) in enumerate(lines):
+        if not changed[n]:
+            # Only keep unchanged rows next to a change, replacing the rest with one '...' line
+            if not (n > 0 and changed[n - 1]) and not (n + 1 < len(lines) and changed[n + 1]):
+                if data_diff[-1][0] != "...":
+                    data_diff.append(["..."] * (len(headers) + 1))
+                continue
+        old = left_data[i + 1] if i is not None else None
+        cells = []
+        for li, ri in zip(left_idx, right_idx):
+            old_value = old[li] if old is not None and li is not None else None
+            new_value = row[ri] if row is not None and ri is not None else None
+            if old_value is not None and new_value is not None and old_value != new_value:
+                action = "->"
+                cells.append(f"{old_value}->{new_value}")
+            elif new_value is not None:
+                cells.append(new_value)
+            else:
+                cells.append(old_value)
+        data_diff.append([action] + cells)
+
+    start = 2 if col_changes else 1
+    if all(line[0] == "..." for line in data_diff[start:]):
+        # No changes to the rows
+        return [line for line in data_diff if line[0] != "..."]
+    return data_diff
+
+
+def get_fetch_state(cogs_dir):
+    """Get the state of the remote spreadsheet & COGS directory at the last fetch from remote.tsv
+    as a dict. The "Synced Version" is the version of the spreadsheet after the last fetch or push.
+    If the spreadsheet has not been fetched, return an empty dict."""
+    state = {}
+    if os.path.exists(f"{cogs_dir}/remote.tsv"):
+        with open(f"{cogs_dir}/remote.tsv", "r") as f:
+            reader = csv.reader(f, delimiter="\t", lineterminator="\n")
+            for row in reader:
+                state[row[0]] = row[1]
+    return state
+
+
+def get_file_hash(path):
+    """Return the hash of the rows of a TSV or CSV file (see get_hash)."""
+    with open(path, "r") as f:
+        if path.endswith("csv"):
+            reader = csv.reader(f)
+        else:
+            reader = csv.reader(f, delimiter="\t")
+        return get_hash(reader)
+
+
+def get_fingerprints(cogs_dir):
+    """Get the fingerprints of the fetched sheets from fingerprint.tsv as a dict of sheet title ->
+    hashes of the values, formats, notes, data validation rules, and properties of that sheet."""
+    fingerprints = {}
+    if os.path.exists(f"{cogs_dir}/fingerprint.tsv"):
+        with open(f"{cogs_dir}/fingerprint.tsv", "r") as f:
+            reader = csv.DictReader(f, delimiter="\t")
+            for row in reader:
+                sheet_title = row["Sheet Title"]
+                del row["Sheet Title"]
+                fingerprints[sheet_title] = row
+    return fingerprints
+
+
+def get_a1_ranges(ranges):
+    """Return a map of cell or range in A1 notation -> key for a list of rectangles. The ranges are
+    sorted by their top left cell in row-major order."""
+    a1_ranges = {}
+    for start_row, start_col, end_row, end_col, key in sorted(ranges, key=lambda r: r[:2]):
+        start = gspread.utils.rowcol_to_a1(start_row, start_col)
+        if start_row == end_row and start_col == end_col:
+            a1_ranges[start] = key
+        else:
+            end = gspread.utils.rowcol_to_a1(end_row, end_col)
+            a1_ranges[f"{start}:{end}"] = key
+    return a1_ranges
+
+
 def get_format_dict(cogs_dir):
     """Get a dict of numerical format ID -> the format dict."""
     if (
@@ -216,6 +795,55 @@ def get_format_dict(cogs_dir):
     return {}
 
 
+def get_hash(rows):
+    """Return a hash of rows (lists of values). Two tables have the same hash when all of their
+    cell values are the same, no matter which format they are stored in."""
+    h = hashlib.sha1()
+    for row in rows:
+        h.update(json.dumps(row).encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def get_index(cogs_dir):
+    """Get the status index from index.tsv as a dict of sheet title -> stat data ("Local Stat",
+    "Cached Stat") and hashes ("Local Hash", "Cached Hash") of the local and cached copies of the
+    sheet, and the summary of the diff between them ("Status") aligned on the "Key Columns". Also
+    return the time the index was written (ns), as stat data from files changed after that time
+    may not be up to date."""
+    index = {}
+    index_path = f"{cogs_dir}/index.tsv"
+    if not os.path.exists(index_path):
+        return index, 0
+    with open(index_path, "r") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        for row in reader:
+            sheet_title = row["Sheet Title"]
+            del row["Sheet Title"]
+            index[sheet_title] = row
+    return index, os.stat(index_path).st_mtime_ns
+
+
+def get_key_columns(details):
+    """Return the key columns of a sheet from its sheet.tsv details as a list. The "Key Columns"
+    are comma-separated column headers used to align rows when diffing the sheet."""
+    keys = details.get("Key Columns") or ""
+    return [k.strip() for k in keys.split(",") if k.strip()]
+
+
+def get_metadata_hash(cogs_dir):
+    """Return a hash of the COGS metadata files (sheet.tsv, format.tsv, etc.). If this changes,
+    the cached data must be fetched again even if the remote spreadsheet has not changed."""
+    h = hashlib.sha1()
+    for name in metadata_files:
+        h.update(name.encode("utf-8"))
+        path = f"{cogs_dir}/{name}"
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
 def get_new_path(tracked_sheets, sheet):
     """Create a distinct sheet path for a sheet."""
     sheet_paths = {
@@ -232,6 +860,36 @@ def get_new_path(tracked_sheets, sheet):
     return sheet_path
 
 
+def get_properties_hash(frozen_rows, frozen_cols):
+    """Return the hash of the properties (frozen rows & columns) of one sheet for fingerprint.tsv.
+    The properties of the fetched sheet and of the local sheet.tsv have the same hash."""
+    return get_hash([[str(int(frozen_rows)), str(int(frozen_cols))]])
+
+
+def get_retry_details(e):
+    """Return the HTTP status and the Retry-After delay in seconds (or None) of an APIError from
+    gspread or an HttpError from googleapiclient."""
+    if isinstance(e, HttpError):
+        status = e.resp.status
+        retry_after = e.resp.get("retry-after")
+    else:
+        status = e.response.status_code
+        retry_after = e.response.headers.get("Retry-After")
+    if retry_after is None:
+        return status, None
+    try:
+        return status, max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        # Retry-After may be an HTTP date
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        now = datetime.datetime.now(tz=retry_at.tzinfo)
+        return status, max(0.0, (retry_at - now).total_seconds())
+    except (TypeError, ValueError):
+        return status, None
+
+
 def get_sheet_formats(cogs_dir):
     """Get a dict of sheet ID -> formatted cells."""
     sheet_to_formats = {}
@@ -254,6 +912,18 @@ def get_sheet_formats(cogs_dir):
     return sheet_to_formats
 
 
+def get_sheet_hashes(cell_to_format, cell_to_note, dv_rows):
+    """Return the hashes of the formats (cell -> format ID), notes (cell -> note), and data
+    validation rules (rows of validation.tsv) of one sheet for fingerprint.tsv. The same hashes are
+    computed from the fetched sheet and from the local format.tsv, note.tsv, and validation.tsv,
+    so that push can tell which of them have changed."""
+    return {
+        "Formats": get_hash([[cell, str(fmt_id)] for cell, fmt_id in cell_to_format.items()]),
+        "Notes": get_hash([[cell, note] for cell, note in cell_to_note.items()]),
+        "Validation": get_hash([[x["Range"], x["Condition"], x["Value"]] for x in dv_rows]),
+    }
+
+
 def get_sheet_notes(cogs_dir):
     """Get a dict of sheet ID -> notes on cells."""
     sheet_to_notes = {}
@@ -285,6 +955,23 @@ def get_sheet_url(config=None):
     return f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}"
 
 
+def get_remote_version(gc, spreadsheet_id):
+    """Get the modified time and version of the spreadsheet from Drive as a dict. This is a cheap
+    metadata request that tells us if anything in the spreadsheet has changed. Return None if the
+    version cannot be retrieved."""
+    try:
+        resp = gc.request(
+            "get",
+            f"{DRIVE_FILES_API_V3_URL}/{spreadsheet_id}",
+            params={"fields": "modifiedTime,version", "supportsAllDrives": True},
+        )
+    except gspread.exceptions.APIError as e:
+        logging.warning("Unable to retrieve the version of the spreadsheet\n" + e.response.text)
+        return None
+    data = resp.json()
+    return {"Modified Time": data.get("modifiedTime", ""), "Version": data.get("version", "")}
+
+
 def get_renamed_sheets(cogs_dir):
     """Get a set of renamed sheets from renamed.tsv as a dict of old name -> new name & path."""
     renamed = {}
@@ -296,6 +983,49 @@ def get_renamed_sheets(cogs_dir):
     return renamed
 
 
+def get_token_cache_path(gcred):
+    """Return the path to the cached access token for the service account and scopes of the
+    credentials in the COGS cache directory, or None if the token cache is not enabled. The token
+    cache is enabled by setting the COGS_TOKEN_CACHE environment variable to 'true'."""
+    if os.environ.get("COGS_TOKEN_CACHE", "").lower() not in ["1", "true", "yes"]:
+        return None
+    key = " ".join([gcred.service_account_email] + sorted(gcred.scopes or []))
+    return os.path.join(
+        get_cache_dir(), "tokens", hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json"
+    )
+
+
+def get_stat(path):
+    """Return the stat data of a file (size, modification time in ns, and inode) as a string for
+    index.tsv."""
+    st = os.stat(path)
+    return f"{st.st_size}:{st.st_mtime_ns}:{st.st_ino}"
+
+
+def get_table_data(path):
+    """Return the rows of a TSV or CSV table as a list of lists, with each row padded to the
+    length of the headers. Return an empty list if the table is empty."""
+    data = []
+    with open(path, "r") as f:
+        if path.endswith("csv"):
+            reader = csv.reader(f)
+        else:
+            reader = csv.reader(f, delimiter="\t")
+        try:
+            header = next(reader)
+        except StopIteration:
+            # No data
+            header = None
+        if header:
+            data.append(header)
+            for row in reader:
+                if len(row) < len(header):
+                    add = [""] * (len(header) - len(row))
+                    row.extend(add)
+                data.append(row)
+    return data
+
+
 def get_tracked_sheets(cogs_dir, include_no_id=True):
     """Get the current tracked sheets in this project from sheet.tsv as a dict of sheet title ->
     path & ID. They may or may not have corresponding cached/local sheets."""
@@ -338,6 +1068,91 @@ def is_valid_role(role):
     return role in ["writer", "reader"]
 
 
+def is_idempotent(method, url, body=None):
+    """Return True if a request to the Google APIs can be sent again after a 5xx response, when the
+    server may already have applied it. Reads and writes of values (but not appends) are
+    idempotent, and so are spreadsheets.batchUpdate requests that only contain IDEMPOTENT_REQUESTS.
+    Other requests (e.g., inserting rows or creating a file) are not."""
+    method = method.upper()
+    if method in ["GET", "HEAD", "PUT", "DELETE"]:
+        return True
+    if "/values" in url:
+        return ":append" not in url
+    if isinstance(body, dict) and "requests" in body:
+        return all(set(request.keys()) <= IDEMPOTENT_REQUESTS for request in body["requests"])
+    return False
+
+
+def is_unchanged(cogs_dir, sheet_title, local_path, fingerprints):
+    """Return True if the local sheet and the cached copy of a sheet are known to have the same
+    values: the cached copy has not changed since the fingerprints were recorded and the local
+    sheet has the same values hash."""
+    values_hash = fingerprints.get(sheet_title, {}).get("Values")
+    if not values_hash:
+        return False
+    cached_path = get_cached_path(cogs_dir, sheet_title)
+    index_path = f"{cogs_dir}/fingerprint.tsv"
+    if not os.path.exists(cached_path) or not os.path.exists(local_path):
+        return False
+    if os.stat(cached_path).st_mtime_ns > os.stat(index_path).st_mtime_ns:
+        return False
+    return get_file_hash(local_path) == values_hash
+
+
+def map_processes(function, args, jobs=1):
+    """Return the results of calling a function with each tuple of arguments, in the same order. If
+    'jobs' is greater than one, the calls are run in up to 'jobs' separate processes."""
+    if jobs > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(args))) as executor:
+            return list(executor.map(function, *zip(*args)))
+    return [function(*a) for a in args]
+
+
+def merge_ranges(a1_ranges):
+    """Merge a list of (cell or range in A1 notation, key) into as few rectangles as possible,
+    where each rectangle has cells with the same key. Return a map of cell or range -> key (see
+    get_a1_ranges). This works on bands of rows with the same cells, so large ranges (e.g., whole
+    columns) do not need to be split into cells."""
+    # Get the bounds of each range and the rows where the cells may change
+    rects = []
+    breaks = set()
+    for a1_range, key in a1_ranges:
+        start, _, end = a1_range.partition(":")
+        start_row, start_col = gspread.utils.a1_to_rowcol(start)
+        end_row, end_col = start_row, start_col
+        if end:
+            end_row, end_col = gspread.utils.a1_to_rowcol(end)
+        rects.append((start_row, start_col, end_row, end_col, key))
+        breaks.update([start_row, end_row + 1])
+
+    # Each band of rows between two breaks has the same runs for each key
+    # The bands are swept in order, keeping only the rectangles that cover the current band
+    rects.sort(key=lambda rect: rect[0])
+    active = []
+    next_rect = 0
+    open_ranges = {}
+    ranges = []
+    breaks = sorted(breaks)
+    for row, next_row in zip(breaks, breaks[1:]):
+        while next_rect < len(rects) and rects[next_rect][0] <= row:
+            active.append(rects[next_rect])
+            next_rect += 1
+        active = [rect for rect in active if rect[2] >= row]
+        cols = {}
+        for _, start_col, _, end_col, key in active:
+            cols.setdefault(key, set()).update(range(start_col, end_col + 1))
+        runs = []
+        for key, key_cols in cols.items():
+            for col in sorted(key_cols):
+                add_to_runs(runs, col, key)
+        if runs:
+            add_row_runs(open_ranges, ranges, row, sorted(runs), end_row=next_row - 1)
+        else:
+            close_ranges(open_ranges, ranges)
+    close_ranges(open_ranges, ranges)
+    return get_a1_ranges(ranges)
+
+
 def set_logging(verbose):
     """Set logging for COGS based on -v/--verbose."""
     if verbose:
@@ -346,6 +1161,58 @@ def set_logging(verbose):
         logging.basicConfig(level=logging.WARNING, format="%(levelname)s: %(message)s")
 
 
+def update_fetch_state(cogs_dir, state):
+    """Write the state of the remote spreadsheet & COGS directory to remote.tsv."""
+    with open(f"{cogs_dir}/remote.tsv", "w") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        for key, value in state.items():
+            writer.writerow([key, value])
+
+
+def update_index(cogs_dir, index):
+    """Write the status index to index.tsv (see get_index)."""
+    rows = []
+    for sheet_title, entry in index.items():
+        row = {"Sheet Title": sheet_title}
+        row.update(entry)
+        rows.append(row)
+    with open(f"{cogs_dir}/index.tsv", "w") as f:
+        writer = csv.DictWriter(
+            f,
+            delimiter="\t",
+            lineterminator="\n",
+            fieldnames=[
+                "Sheet Title",
+                "Local Stat",
+                "Local Hash",
+                "Cached Stat",
+                "Cached Hash",
+                "Key Columns",
+                "Status",
+            ],
+        )
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def update_fingerprints(cogs_dir, fingerprints):
+    """Write the fingerprints of the fetched sheets to fingerprint.tsv."""
+    rows = []
+    for sheet_title, fingerprint in fingerprints.items():
+        row = {"Sheet Title": sheet_title}
+        row.update(fingerprint)
+        rows.append(row)
+    with open(f"{cogs_dir}/fingerprint.tsv", "w") as f:
+        writer = csv.DictWriter(
+            f,
+            delimiter="\t",
+            lineterminator="\n",
+            fieldnames=["Sheet Title", "Values", "Formats", "Notes", "Validation", "Properties"],
+        )
+        writer.writeheader()
+        writer.writerows(rows)
+
+
 def update_format(cogs_dir, sheet_formats, removed_titles, overwrite=False):
     """Update format.tsv with current remote formatting.
     Remove any lines with a Sheet ID in removed_ids."""
@@ -396,6 +1263,26 @@ def update_note(cogs_dir, sheet_notes, removed_titles, overwrite=False):
         writer.writerows(note_rows)
 
 
+def update_cached_token(gcred):
+    """If the token cache is enabled (see get_token_cache_path), write the access token of the
+    credentials to the cache so that other COGS commands can use it until it expires. The file is
+    only readable by the current user."""
+    path = get_token_cache_path(gcred)
+    if not path or not gcred.token or not gcred.expiry:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # mkstemp creates the file with 0600 permissions
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {"token": gcred.token, "expiry": gcred.expiry.strftime(TOKEN_EXPIRY_FORMAT)}, f
+            )
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.debug(f"Unable to cache access token at {path}: {str(e)}")
+
+
 def update_data_validation(cogs_dir, sheet_dv_rules, removed_titles, overwrite=False):
     """ """
     # TODO - can we be smarter and error on overlap?
@@ -442,6 +1329,7 @@ def update_sheet(cogs_dir, sheet_details, removed_titles):
                 "Description",
                 "Frozen Rows",
                 "Frozen Columns",
+                "Key Columns",
                 "Ignore",
             ],
         )
@@ -162,6 +162,7 @@ def write_data(sheet, title, credentials=None):
                 "Description",
                 "Frozen Rows",
                 "Frozen Columns",
+                "Key Columns",
                 "Ignore",
             ],
         )
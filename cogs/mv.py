@@ -120,6 +120,7 @@ def mv(path, new_path, new_title=None, force=False, verbose=False):
                 "Description",
                 "Frozen Rows",
                 "Frozen Columns",
+                "Key Columns",
                 "Ignore",
             ],
         )
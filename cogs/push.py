@@ -1,28 +1,204 @@
 import csv
+import difflib
 import gspread.exceptions
 import gspread.utils
 import gspread_formatting as gf
+import json
 import logging
 import os
 import re
+import tempfile
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cogs.exceptions import PushError
 from cogs.helpers import (
     get_tracked_sheets,
     set_logging,
     validate_cogs_project,
     get_cached_path,
     get_config,
-    get_client_from_config,
+    get_fetch_state,
+    get_file_hash,
+    get_remote_version,
     get_renamed_sheets,
+    get_session,
     get_sheet_formats,
+    get_sheet_hashes,
     get_format_dict,
     get_sheet_notes,
     get_data_validation,
+    get_fingerprints,
+    get_hash,
+    get_properties_hash,
+    merge_ranges,
+    update_fetch_state,
+    update_fingerprints,
 )
 
+# Maximum size in bytes of the requests sent with one batch update
+# The Sheets API limits the size of a request to about 10MB
+MAX_BATCH_BYTES = 4 * 1024 * 1024
 
-def clear_remote_sheets(spreadsheet, tracked_sheets, renamed_local):
-    """Clear all data from remote sheets and return a map of sheet title -> sheet obj."""
+# Values are uploaded in chunks of up to this many bytes (estimated) and cells, so that large
+# sheets do not go over the request size limit
+MAX_CHUNK_BYTES = 2 * 1024 * 1024
+MAX_CHUNK_CELLS = 100000
+
+# Number of empty rows and columns to add after the table in each sheet
+# These can be changed with the "Padding Rows" and "Padding Columns" keys in config.tsv
+PADDING_ROWS = 0
+PADDING_COLUMNS = 0
+
+
+class PushPlan:
+    """The changes to make to the spreadsheet for a push, gathered so that they can be sent with as
+    few requests as possible. Requests for spreadsheets.batchUpdate are added to a phase, and the
+    phases are sent in order (requests within a phase in the order they were added):
+    - structure: add, rename, clear, and freeze sheets, insert and delete rows
+    - metadata: clear and add formats and notes, once the sheets exist and the rows have moved
+    - delete: delete sheets, last so that the spreadsheet always has at least one sheet
+    Then the values are sent with spreadsheets.values.batchUpdate in chunks of up to
+    MAX_CHUNK_BYTES and MAX_CHUNK_CELLS, using up to 'jobs' concurrent requests. Finally, the data
+    validation rules are sent on their own, so that an invalid rule does not stop the rest of the
+    push."""
+
+    def __init__(self):
+        self.requests = {"structure": [], "metadata": [], "delete": [], "validation": []}
+        # Values to write as (sheet title, first row, iterable of rows)
+        self.values = []
+
+    def add(self, phase, request):
+        """Add a request for spreadsheets.batchUpdate to a phase."""
+        self.requests[phase].append(request)
+
+    def add_values(self, sheet_title, row, values):
+        """Add rows of values to write to a sheet, starting at column A of a row (1-based). The
+        values may be any iterable (e.g., a generator that reads a file), which is only read when
+        the values are uploaded."""
+        self.values.append((sheet_title, row, values))
+
+    def get_chunks(self):
+        """Yield the values to upload in chunks as (ranges of values, number of cells). The rows
+        of each sheet are split into ranges so that each fits in a chunk; small ranges share a
+        chunk."""
+        data = []
+        chunk_bytes = 0
+        chunk_cells = 0
+        for sheet_title, row, values in self.values:
+            sheet_title = sheet_title.replace("'", "''")
+            rows = None
+            for value_row in values:
+                row_bytes = sum([len(v.encode("utf-8")) + 3 for v in value_row]) + 2
+                row_cells = max(1, len(value_row))
+                if data and (
+                    chunk_bytes + row_bytes > MAX_CHUNK_BYTES
+                    or chunk_cells + row_cells > MAX_CHUNK_CELLS
+                ):
+                    yield data, chunk_cells
+                    data = []
+                    chunk_bytes = 0
+                    chunk_cells = 0
+                    rows = None
+                if rows is None:
+                    # Start a new range at this row
+                    rows = []
+                    data.append({"range": f"'{sheet_title}'!A{row}", "values": rows})
+                rows.append(value_row)
+                chunk_bytes += row_bytes
+                chunk_cells += row_cells
+                row += 1
+        if data:
+            yield data, chunk_cells
+
+    def execute(self, spreadsheet, jobs=1):
+        """Send all changes to the spreadsheet, using up to 'jobs' concurrent requests to upload
+        the values. Return the number of write requests that were applied."""
+        writes = 0
+        requests = self.requests["structure"] + self.requests["metadata"] + self.requests["delete"]
+        for batch in get_request_batches(requests):
+            logging.info(f"sending {len(batch)} change(s) to spreadsheet")
+            spreadsheet.batch_update({"requests": batch})
+            writes += 1
+
+        def upload(i, data, cells):
+            spreadsheet.values_batch_update(body={"valueInputOption": "RAW", "data": data})
+            logging.info(f"uploaded values chunk {i} ({cells} cells)")
+
+        # Chunks are only read as there is a worker to upload them, so that the values of large
+        # sheets are never all in memory
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            uploads = deque()
+            for i, (data, cells) in enumerate(self.get_chunks(), 1):
+                if len(uploads) >= jobs:
+                    uploads.popleft().result()
+                    writes += 1
+                uploads.append(executor.submit(upload, i, data, cells))
+            for future in uploads:
+                future.result()
+                writes += 1
+
+        requests = self.requests["validation"]
+        if not requests:
+            return writes
+        try:
+            logging.info(f"adding {len(requests)} data validation rules to spreadsheet")
+            for batch in get_request_batches(requests):
+                spreadsheet.batch_update({"requests": batch})
+                writes += 1
+        except gspread.exceptions.APIError as e:
+            logging.error(
+                f"Unable to add {len(requests)} data validation rules to spreadsheet\n"
+                + e.response.text
+            )
+        return writes
+
+
+def get_request_batches(requests, max_bytes=MAX_BATCH_BYTES):
+    """Split a list of requests into batches where the JSON of the requests in each batch is up to
+    max_bytes in total. A request larger than max_bytes gets its own batch."""
+    batch = []
+    batch_bytes = 0
+    for request in requests:
+        request_bytes = len(json.dumps(request))
+        if batch and batch_bytes + request_bytes > max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(request)
+        batch_bytes += request_bytes
+    if batch:
+        yield batch
+
+
+def get_clear_request(sheet_id, fields):
+    """Return a request to clear fields (e.g., userEnteredFormat, or * for everything) from all
+    cells of a sheet."""
+    return {"updateCells": {"range": {"sheetId": sheet_id}, "fields": fields}}
+
+
+def get_grid_range(sheet_id, a1_range):
+    """Return the GridRange of a cell or range in A1 notation on a sheet."""
+    start, _, end = a1_range.partition(":")
+    start_row, start_col = gspread.utils.a1_to_rowcol(start)
+    end_row, end_col = start_row, start_col
+    if end:
+        end_row, end_col = gspread.utils.a1_to_rowcol(end)
+    return {
+        "sheetId": sheet_id,
+        "startRowIndex": start_row - 1,
+        "endRowIndex": end_row,
+        "startColumnIndex": start_col - 1,
+        "endColumnIndex": end_col,
+    }
+
+
+def clear_remote_sheets(spreadsheet, plan, tracked_sheets, renamed_local, incremental=None):
+    """Add requests to clear all data from remote sheets to the plan, except for the sheets that
+    will be pushed incrementally and the sheets that will be deleted, and rename the sheets that
+    were renamed locally. Return a map of sheet title (after renaming) -> sheet obj."""
+    if not incremental:
+        incremental = set()
     remote_sheets = {}
     for sheet in spreadsheet.worksheets():
         sheet_title = sheet.title
@@ -30,110 +206,423 @@ def clear_remote_sheets(spreadsheet, tracked_sheets, renamed_local):
             remote_sheets[sheet_title] = sheet
             continue
 
-        requests = {"requests": [{"updateCells": {"range": {"sheetId": sheet.id}, "fields": "*"}}]}
-        spreadsheet.batch_update(requests)
+        # Sheets that are pushed incrementally are known by their title after renaming
+        local_title = sheet_title
+        if sheet_title in renamed_local:
+            local_title = renamed_local[sheet_title]["new"]
+        if local_title not in incremental and (
+            sheet_title in tracked_sheets or sheet_title in renamed_local
+        ):
+            plan.add("structure", get_clear_request(sheet.id, "*"))
 
         if sheet_title in renamed_local:
             # Maybe rename
             new_title = renamed_local[sheet_title]["new"]
             logging.info(f"Renaming remote sheet '{sheet_title}' to {new_title}")
-            sheet.update_title(new_title)
+            plan.add(
+                "structure",
+                {
+                    "updateSheetProperties": {
+                        "properties": {"sheetId": sheet.id, "title": new_title},
+                        "fields": "title",
+                    }
+                },
+            )
             remote_sheets[new_title] = sheet
         else:
             remote_sheets[sheet_title] = sheet
     return remote_sheets
 
 
-def push_data(cogs_dir, spreadsheet, tracked_sheets, remote_sheets):
-    """Push all tracked sheets to the spreadsheet. Update sheets in COGS tracked directory. Return
-    updated rows for sheet.tsv."""
+def get_grid_extents(sheet_formats, sheet_notes, data_validation):
+    """Return a map of sheet title -> (rows, columns) of the smallest grid that holds all of the
+    formats, notes, and data validation rules of the sheet."""
+    extents = {}
+    for sheet_to_ranges in [sheet_formats, sheet_notes]:
+        for sheet_title, ranges in sheet_to_ranges.items():
+            for a1_range in ranges:
+                update_grid_extent(extents, sheet_title, a1_range)
+    for sheet_title, dv_rules in data_validation.items():
+        for dv_rule in dv_rules:
+            update_grid_extent(extents, sheet_title, dv_rule["Range"])
+    return extents
+
+
+def get_incremental_sheets(cogs_dir, tracked_sheets, synced):
+    """Return the titles of the tracked sheets that can be pushed incrementally. The remote
+    spreadsheet must not have changed since it was last synced (fetched or pushed), and the cached
+    copy of the sheet must not have changed since then, so that the remote sheet is known to match
+    the cached copy and the fingerprint of the sheet."""
+    if not synced:
+        return set()
+    fingerprints = get_fingerprints(cogs_dir)
+    incremental = set()
+    for sheet_title, details in tracked_sheets.items():
+        if details.get("Ignore") or not details["ID"].strip():
+            continue
+        cached_path = get_cached_path(cogs_dir, sheet_title)
+        values_hash = fingerprints.get(sheet_title, {}).get("Values")
+        if values_hash and os.path.exists(cached_path):
+            if get_file_hash(cached_path) == values_hash:
+                incremental.add(sheet_title)
+    return incremental
+
+
+def get_padding(config):
+    """Return the number of empty (rows, columns) to add after the table in each sheet from COGS
+    configuration."""
+    try:
+        padding_rows = int(config.get("Padding Rows", PADDING_ROWS))
+        padding_cols = int(config.get("Padding Columns", PADDING_COLUMNS))
+    except ValueError as e:
+        raise PushError(f"padding in COGS configuration must be a number; {str(e)}")
+    if padding_rows < 0 or padding_cols < 0:
+        raise PushError("padding in COGS configuration must not be negative")
+    return padding_rows, padding_cols
+
+
+def get_synced_version(old_version, new_version, writes):
+    """Return the version of the spreadsheet after a push if the push is the only change since the
+    version before the push, i.e., the version has increased by the number of write requests of
+    the push. Otherwise (or if either version is unknown), return None."""
+    try:
+        if int(new_version["Version"]) == int(old_version["Version"]) + writes:
+            return new_version["Version"]
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def get_untouched_sheets(
+    cogs_dir, tracked_sheets, incremental, sheet_formats, sheet_notes, data_validation
+):
+    """Return the titles of the incrementally pushed sheets that have not been changed locally
+    since the last sync: the hashes of the local file, properties (frozen rows & columns), formats,
+    notes, and data validation rules all match the fingerprint of the cached copy. These sheets do
+    not need to be pushed at all."""
+    fingerprints = get_fingerprints(cogs_dir)
+    untouched = set()
+    for sheet_title in incremental:
+        details = tracked_sheets[sheet_title]
+        fingerprint = fingerprints[sheet_title]
+        if not os.path.exists(details["Path"]):
+            continue
+        hashes = get_sheet_hashes(
+            sheet_formats.get(sheet_title, {}),
+            sheet_notes.get(sheet_title, {}),
+            data_validation.get(sheet_title, []),
+        )
+        hashes["Values"] = get_file_hash(details["Path"])
+        hashes["Properties"] = get_properties_hash(
+            details["Frozen Rows"], details["Frozen Columns"]
+        )
+        if all(fingerprint.get(key) == value for key, value in hashes.items()):
+            untouched.add(sheet_title)
+    return untouched
+
+
+def copy_rows(reader, writer, size, keys=None):
+    """Write each row from a CSV reader to a CSV writer and yield it, so that the rows can be
+    processed (e.g., hashed) in the same pass. Count the rows and the maximum number of columns in
+    the size dict. If a list of keys is given, add the key (see get_row_key) of each row."""
+    for row in reader:
+        writer.writerow(row)
+        size["rows"] += 1
+        size["cols"] = max(size["cols"], len(row))
+        if keys is not None:
+            keys.append(get_row_key(row))
+        yield row
+
+
+def read_rows(path):
+    """Yield the rows of a TSV file."""
+    with open(path, "r") as f:
+        yield from csv.reader(f, delimiter="\t")
+
+
+def get_rows_to_append(changes, row_count, frozen_rows):
+    """Return the number of rows to add to the end of a sheet with row_count rows, of which
+    frozen_rows are frozen, before applying the row changes (see push_row_changes). A sheet must
+    always have at least one row that is not frozen, so a sheet cannot have all of its unfrozen
+    rows deleted."""
+    min_rows = row_count
+    for tag, i1, i2, j1, j2 in reversed(changes):
+        row_count += (j2 - j1) - (i2 - i1)
+        min_rows = min(min_rows, row_count)
+    return max(0, frozen_rows + 1 - min_rows)
+
+
+def get_row_key(row):
+    """Return a row as a tuple without trailing empty cells, for comparing rows."""
+    end = len(row)
+    while end > 0 and row[end - 1] == "":
+        end -= 1
+    return tuple(row[:end])
+
+
+def get_row_changes(old_rows, new_rows):
+    """Compare the rows of the cached copy of a sheet (old) to the rows of the local sheet (new).
+    Return the changes as a list of (tag, i1, i2, j1, j2) like difflib.SequenceMatcher.get_opcodes,
+    without the equal rows. Rows are compared without trailing empty cells."""
+    old_keys = [get_row_key(row) for row in old_rows]
+    new_keys = [get_row_key(row) for row in new_rows]
+
+    # Skip the rows that are the same at the start and end before matching the rest
+    limit = min(len(old_keys), len(new_keys))
+    start = 0
+    while start < limit and old_keys[start] == new_keys[start]:
+        start += 1
+    end = 0
+    while end < limit - start and old_keys[-end - 1] == new_keys[-end - 1]:
+        end += 1
+    old_end = len(old_keys) - end
+    new_end = len(new_keys) - end
+
+    matcher = difflib.SequenceMatcher(
+        None, old_keys[start:old_end], new_keys[start:new_end], autojunk=False
+    )
+    changes = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            changes.append((tag, i1 + start, i2 + start, j1 + start, j2 + start))
+    return changes
+
+
+def update_grid_extent(extents, sheet_title, a1_range):
+    """Extend the (rows, columns) of a sheet in extents to hold a cell or range in A1 notation."""
+    end = a1_range.split(":")[-1]
+    row, col = gspread.utils.a1_to_rowcol(end)
+    rows, cols = extents.get(sheet_title, (0, 0))
+    extents[sheet_title] = (max(rows, row), max(cols, col))
+
+
+def push_row_changes(plan, sheet_id, sheet_title, changes, rows, width):
+    """Add requests to apply the row changes (see get_row_changes) to a remote sheet to the plan.
+    Rows are deleted and inserted from the bottom up so that the row indexes of the changes above
+    stay the same. Then the values of the changed rows are written, with each row padded to the
+    width so that any old values are cleared. Return True if any rows were inserted or deleted,
+    meaning that the formats, notes, and data validation have moved."""
+    shifted = False
+    for tag, i1, i2, j1, j2 in reversed(changes):
+        if j2 - j1 < i2 - i1:
+            # Delete the old rows that have no new row to replace them
+            plan.add(
+                "structure",
+                {
+                    "deleteDimension": {
+                        "range": {
+                            "sheetId": sheet_id,
+                            "dimension": "ROWS",
+                            "startIndex": i1 + j2 - j1,
+                            "endIndex": i2,
+                        }
+                    }
+                },
+            )
+            shifted = True
+        elif j2 - j1 > i2 - i1:
+            # Insert rows for the new rows that have no old row to replace
+            plan.add(
+                "structure",
+                {
+                    "insertDimension": {
+                        "range": {
+                            "sheetId": sheet_id,
+                            "dimension": "ROWS",
+                            "startIndex": i2,
+                            "endIndex": i2 + (j2 - j1) - (i2 - i1),
+                        },
+                        "inheritFromBefore": i2 > 0,
+                    }
+                },
+            )
+            shifted = True
+
+    for tag, i1, i2, j1, j2 in changes:
+        if j2 > j1:
+            values = [list(row) + [""] * (width - len(row)) for row in rows[j1:j2]]
+            plan.add_values(sheet_title, j1 + 1, values)
+    return shifted
+
+
+def push_data(
+    cogs_dir,
+    plan,
+    tracked_sheets,
+    remote_sheets,
+    fingerprints,
+    incremental=None,
+    untouched=None,
+    extents=None,
+    padding=(PADDING_ROWS, PADDING_COLUMNS),
+    new_cached=None,
+):
+    """Add requests to push the tracked sheets that are not 'untouched' to the plan, with only the
+    changed rows of 'incremental' sheets. Return rows for sheet.tsv, the sheets where rows were
+    inserted or deleted, and new_cached (map of temporary copy -> cached copy)."""
+    if not incremental:
+        incremental = set()
+    if not untouched:
+        untouched = set()
+    if not extents:
+        extents = {}
+    # New sheets are given IDs up front so that later requests can refer to them
+    next_sheet_id = max([sheet.id for sheet in remote_sheets.values()] + [0]) + 1
+    shifted = set()
     sheet_rows = []
+    if new_cached is None:
+        new_cached = {}
     for sheet_title, details in tracked_sheets.items():
         if details.get("Ignore"):
             logging.info(f"Skipping ignored sheet '{sheet_title}'")
             details["Title"] = sheet_title
             sheet_rows.append(details)
             continue
+        if sheet_title in untouched:
+            logging.info(f"Skipping unchanged sheet '{sheet_title}'")
+            details["Title"] = sheet_title
+            details["ID"] = remote_sheets[sheet_title].id
+            sheet_rows.append(details)
+            continue
         sheet_path = details["Path"]
         delimiter = "\t"
         if sheet_path.endswith(".csv"):
             delimiter = ","
-        rows = []
-        cols = 0
         if not os.path.exists(sheet_path):
             logging.warning(f"'{sheet_title}' exists remotely but has not been pulled")
             continue
-        with open(sheet_path, "r") as fr:
+
+        # Copy the rows to a temporary file in one pass, getting the size of the table
+        # For incremental sheets, the rows are also kept (without trailing empty cells) to compare
+        cached_path = get_cached_path(cogs_dir, sheet_title)
+        fd, tmp_path = tempfile.mkstemp(dir=cogs_dir, suffix=".tsv")
+        new_cached[tmp_path] = cached_path
+        size = {"rows": 0, "cols": 0}
+        new_keys = None
+        if sheet_title in incremental:
+            new_keys = []
+        with open(sheet_path, "r") as fr, os.fdopen(fd, "w") as fw:
             reader = csv.reader(fr, delimiter=delimiter)
-            tracked_sheet = get_cached_path(cogs_dir, sheet_title)
-            with open(tracked_sheet, "w") as fw:
-                writer = csv.writer(fw, delimiter="\t", lineterminator="\n")
-                for row in reader:
-                    writer.writerow(row)
-                    row_len = len(row)
-                    if row_len > cols:
-                        cols = row_len
-                    rows.append(row)
+            writer = csv.writer(fw, delimiter="\t", lineterminator="\n")
+            values_hash = get_hash(copy_rows(reader, writer, size, keys=new_keys))
+        cols = size["cols"]
 
         # Set sheet size
-        if len(rows) < 500:
-            y_size = 500
-        else:
-            y_size = len(rows) + 10
-        if cols < 20:
-            x_size = 20
-        else:
-            x_size = cols + 1
+        # The grid must have at least one row and column that is not frozen
+        frozen_row = int(details["Frozen Rows"])
+        frozen_col = int(details["Frozen Columns"])
+        min_rows, min_cols = extents.get(sheet_title, (0, 0))
+        y_size = max(size["rows"] + padding[0], min_rows, frozen_row + 1)
+        x_size = max(cols + padding[1], min_cols, frozen_col + 1)
 
         # Create or get the sheet
         if sheet_title not in remote_sheets:
             logging.info(f"creating sheet '{sheet_title}'")
-            sheet = spreadsheet.add_worksheet(sheet_title, rows=y_size, cols=x_size)
+            sheet_id = next_sheet_id
+            next_sheet_id += 1
+            plan.add(
+                "structure",
+                {
+                    "addSheet": {
+                        "properties": {
+                            "sheetId": sheet_id,
+                            "title": sheet_title,
+                            "gridProperties": {"rowCount": y_size, "columnCount": x_size},
+                        }
+                    }
+                },
+            )
         else:
-            sheet = remote_sheets[sheet_title]
-        details["Title"] = sheet.title
-        details["ID"] = sheet.id
+            sheet_id = remote_sheets[sheet_title].id
+        details["Title"] = sheet_title
+        details["ID"] = sheet_id
         sheet_rows.append(details)
 
-        logging.info(f"pushing data from {sheet_path} to remote sheet '{sheet_title}'")
+        if sheet_title in incremental:
+            # Only send the rows that have changed since the last sync (the cached copy)
+            with open(cached_path, "r") as f:
+                old_keys = [get_row_key(row) for row in csv.reader(f, delimiter="\t")]
+            changes = get_row_changes(old_keys, new_keys)
+            if changes and not new_keys:
+                # A sheet cannot have all of its rows deleted, so clear it instead
+                logging.info(f"clearing remote sheet '{sheet_title}'")
+                plan.add("structure", get_clear_request(sheet_id, "*"))
+                shifted.add(sheet_title)
+            elif changes:
+                logging.info(
+                    f"pushing {len(changes)} change(s) from {sheet_path} to remote sheet "
+                    f"'{sheet_title}'"
+                )
+                # The grid is only resized after the rows are deleted, so it may need more rows
+                sheet = remote_sheets[sheet_title]
+                append_rows = get_rows_to_append(changes, sheet.row_count, sheet.frozen_row_count)
+                if append_rows:
+                    plan.add(
+                        "structure",
+                        {
+                            "appendDimension": {
+                                "sheetId": sheet_id,
+                                "dimension": "ROWS",
+                                "length": append_rows,
+                            }
+                        },
+                    )
+                # Rows are padded to clear any old values, but not past the end of the grid
+                width = min(x_size, max([cols] + [len(row) for row in old_keys]))
+                if push_row_changes(plan, sheet_id, sheet_title, changes, new_keys, width):
+                    shifted.add(sheet_title)
+            else:
+                logging.info(f"no changes to push from {sheet_path} to '{sheet_title}'")
+        else:
+            logging.info(f"pushing data from {sheet_path} to remote sheet '{sheet_title}'")
 
-        # Add new values to ws from local
-        spreadsheet.values_update(
-            f"{sheet_title}!A1",
-            params={"valueInputOption": "RAW"},
-            body={"values": rows},
+            # Add new values to ws from local, read from the temporary copy when uploaded
+            plan.add_values(sheet_title, 1, read_rows(tmp_path))
+
+        # Resize the sheet & add frozen rows & cols, after any rows have been inserted or deleted
+        plan.add(
+            "structure",
+            {
+                "updateSheetProperties": {
+                    "properties": {
+                        "sheetId": sheet_id,
+                        "gridProperties": {
+                            "rowCount": y_size,
+                            "columnCount": x_size,
+                            "frozenRowCount": frozen_row,
+                            "frozenColumnCount": frozen_col,
+                        },
+                    },
+                    "fields": ",".join(
+                        [
+                            "gridProperties.rowCount",
+                            "gridProperties.columnCount",
+                            "gridProperties.frozenRowCount",
+                            "gridProperties.frozenColumnCount",
+                        ]
+                    ),
+                }
+            },
         )
 
-        # Add frozen rows & cols
-        frozen_row = int(details["Frozen Rows"])
-        frozen_col = int(details["Frozen Columns"])
-        sheet.freeze(frozen_row, frozen_col)
+        # The cached copy will match the remote sheet
+        if sheet_title not in fingerprints:
+            fingerprints[sheet_title] = {}
+        fingerprints[sheet_title]["Values"] = values_hash
+        fingerprints[sheet_title]["Properties"] = get_properties_hash(frozen_row, frozen_col)
 
-        # Copy this table into COGS data
-        cached_name = get_cached_path(cogs_dir, sheet_title)
-        with open(cached_name, "w") as f:
-            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
-            writer.writerows(rows)
-    return sheet_rows
+    return sheet_rows, shifted, new_cached
 
 
-def push_data_validation(spreadsheet, data_validation, tracked_sheets):
-    """Add data validation rules from validation.tsv to the spreadsheet."""
-    requests = []
+def push_data_validation(plan, data_validation, tracked_sheets):
+    """Add requests to add data validation rules from validation.tsv to the plan. Ranges with the
+    same rule are merged into as few rectangles as possible, with one request per rectangle."""
     for sheet_title, dv_rules in data_validation.items():
         sheet_id = tracked_sheets[sheet_title]["ID"]
-        for dv_rule in dv_rules:
-            dv_range = dv_rule["Range"]
-            if ":" in dv_range:
-                start = dv_range.split(":")[0]
-                end = dv_range.split(":")[1]
-            else:
-                start = dv_range
-                end = dv_range
-            start_row, start_col = gspread.utils.a1_to_rowcol(start)
-            end_row, end_col = gspread.utils.a1_to_rowcol(end)
-            condition = dv_rule["Condition"]
-            value_str = dv_rule["Value"]
+        dv_ranges = merge_ranges(
+            [(dv_rule["Range"], (dv_rule["Condition"], dv_rule["Value"])) for dv_rule in dv_rules]
+        )
+        for dv_range, (condition, value_str) in dv_ranges.items():
             values = []
             if value_str != "":
                 values = re.compile(r"(?<!\\), ").split(value_str)
@@ -144,118 +633,87 @@ def push_data_validation(spreadsheet, data_validation, tracked_sheets):
             show_ui = False
             if condition.endswith("LIST"):
                 show_ui = True
-            requests.append(
+            plan.add(
+                "validation",
                 {
-                    "updateCells": {
-                        "range": {
-                            "sheetId": sheet_id,
-                            "startRowIndex": start_row - 1,
-                            "endRowIndex": end_row,
-                            "startColumnIndex": start_col - 1,
-                            "endColumnIndex": end_col,
+                    "setDataValidation": {
+                        "range": get_grid_range(sheet_id, dv_range),
+                        "rule": {
+                            "condition": {"type": condition, "values": value_obj},
+                            "showCustomUi": show_ui,
                         },
-                        "rows": [
-                            {
-                                "values": {
-                                    "dataValidation": {
-                                        "condition": {"type": condition, "values": value_obj},
-                                        "showCustomUi": show_ui,
-                                    }
-                                }
-                            }
-                        ],
-                        "fields": "dataValidation",
                     }
-                }
+                },
             )
-    if not requests:
-        return
-    try:
-        logging.info(f"adding {len(requests)} data validation rules to spreadsheet")
-        spreadsheet.batch_update({"requests": requests})
-    except gspread.exceptions.APIError as e:
-        logging.error(
-            f"Unable to add {len(requests)} data validation rules to spreadsheet\n"
-            + e.response.text
-        )
 
 
-def push_formats(spreadsheet, id_to_format, sheet_formats):
-    """Batch add formats to a spreadsheet."""
+def push_formats(plan, id_to_format, sheet_formats, tracked_sheets):
+    """Add requests to add formats from format.tsv to the plan, with one request per range."""
     for sheet_title, cell_to_format in sheet_formats.items():
-        worksheet = spreadsheet.worksheet(sheet_title)
-        requests = []
+        sheet_id = tracked_sheets[sheet_title]["ID"]
         for cell, fmt_id in cell_to_format.items():
             fmt = id_to_format[int(fmt_id)]
             cell_format = gf.CellFormat.from_props(fmt)
-            requests.append((cell, cell_format))
-        if requests:
-            logging.info(f"adding {len(requests)} formats to sheet '{sheet_title}")
-            gf.format_cell_ranges(worksheet, requests)
+            plan.add(
+                "metadata",
+                {
+                    "repeatCell": {
+                        "range": get_grid_range(sheet_id, cell),
+                        "cell": {"userEnteredFormat": cell_format.to_props()},
+                        "fields": ",".join(cell_format.affected_fields("userEnteredFormat")),
+                    }
+                },
+            )
+        if cell_to_format:
+            logging.info(f"adding {len(cell_to_format)} formats to sheet '{sheet_title}'")
 
 
-def push_notes(spreadsheet, sheet_notes, tracked_sheets):
-    """Batch add notes to a spreadsheet."""
-    requests = []
+def push_notes(plan, sheet_notes, tracked_sheets):
+    """Add requests to add notes from note.tsv to the plan."""
     for sheet_title, cell_to_note in sheet_notes.items():
         sheet_id = tracked_sheets[sheet_title]["ID"]
         for cell, note in cell_to_note.items():
-            row, col = gspread.utils.a1_to_rowcol(cell)
-            requests.append(
+            plan.add(
+                "metadata",
                 {
                     "updateCells": {
-                        "range": {
-                            "sheetId": sheet_id,
-                            "startRowIndex": row - 1,
-                            "endRowIndex": row,
-                            "startColumnIndex": col - 1,
-                            "endColumnIndex": col,
-                        },
+                        "range": get_grid_range(sheet_id, cell),
                         "rows": [{"values": [{"note": note}]}],
                         "fields": "note",
                     }
-                }
+                },
             )
-    if not requests:
-        return
-    try:
-        logging.info(f"adding {len(requests)} notes to spreadsheet")
-        spreadsheet.batch_update({"requests": requests})
-    except gspread.exceptions.APIError as e:
-        logging.error(f"Unable to add {len(requests)} notes to spreadsheet\n" + e.response.text)
+        if cell_to_note:
+            logging.info(f"adding {len(cell_to_note)} notes to sheet '{sheet_title}'")
 
 
-def push(verbose=False):
+def push(jobs=1, verbose=False):
     """Push local tables to the spreadsheet as sheets. Only the sheets in sheet.tsv will be
     pushed. If a sheet in the Sheet does not exist in the local sheet.tsv, it will be removed
     from the Sheet. Any sheet in sheet.tsv that does not exist in the Sheet will be created.
-    Any sheet in sheet.tsv that does exist will be updated."""
+    Any sheet in sheet.tsv that does exist will be updated. All changes to the sheets are made
+    first, then the values of the sheets are uploaded with up to 'jobs' concurrent requests."""
     set_logging(verbose)
+    if jobs < 1:
+        raise PushError(f"the number of jobs must be at least 1 (got {jobs})")
     cogs_dir = validate_cogs_project()
     config = get_config(cogs_dir)
-    gc = get_client_from_config(config)
-    spreadsheet = gc.open_by_key(config["Spreadsheet ID"])
+    padding = get_padding(config)
+    session = get_session(config)
+    spreadsheet = session.client.open_by_key(config["Spreadsheet ID"])
 
     # Get tracked sheets
     tracked_sheets = get_tracked_sheets(cogs_dir)
     renamed_local = get_renamed_sheets(cogs_dir)
 
-    # Clear existing sheets (wait to delete any that were removed)
-    # If we delete first, could throw error where we try to delete the last remaining ws
-    remote_sheets = clear_remote_sheets(spreadsheet, tracked_sheets, renamed_local)
-
-    # Add new data to the sheets in the Sheet and return headers & sheets details
-    sheet_rows = push_data(cogs_dir, spreadsheet, tracked_sheets, remote_sheets)
-
-    # Remove sheets from remote if needed
-    for sheet_title, sheet in remote_sheets.items():
-        if sheet_title not in tracked_sheets.keys():
-            logging.info(f"removing sheet '{sheet_title}'")
-            # Remove remote copy
-            spreadsheet.del_worksheet(sheet)
-            # Remove cached copy
-            if os.path.exists(f"{cogs_dir}/tracked/{sheet_title}.tsv"):
-                os.remove(f"{cogs_dir}/tracked/{sheet_title}.tsv")
+    # If the spreadsheet has not changed since the last fetch or push, the remote sheets match
+    # the cached sheets and only the changes need to be pushed
+    remote_version = get_remote_version(session.client, config["Spreadsheet ID"])
+    synced = (
+        remote_version is not None
+        and get_fetch_state(cogs_dir).get("Synced Version") == remote_version["Version"]
+    )
+    incremental = get_incremental_sheets(cogs_dir, tracked_sheets, synced)
 
     # Get formatting and notes on the sheets
     sheet_formats = get_sheet_formats(cogs_dir)
@@ -263,10 +721,104 @@ def push(verbose=False):
     sheet_notes = get_sheet_notes(cogs_dir)
     data_validation = get_data_validation(cogs_dir)
 
-    # Add formatting, notes, and data validation
-    push_data_validation(spreadsheet, data_validation, tracked_sheets)
-    push_formats(spreadsheet, id_to_format, sheet_formats)
-    push_notes(spreadsheet, sheet_notes, tracked_sheets)
+    # Sheets that have not changed at all since the last sync are not pushed
+    untouched = get_untouched_sheets(
+        cogs_dir, tracked_sheets, incremental, sheet_formats, sheet_notes, data_validation
+    )
+
+    # All changes are gathered in a plan and sent at the end with as few requests as possible
+    plan = PushPlan()
+
+    # Clear existing sheets (deleting any that were removed is planned last)
+    # If we delete first, could throw error where we try to delete the last remaining ws
+    remote_sheets = clear_remote_sheets(
+        spreadsheet, plan, tracked_sheets, renamed_local, incremental
+    )
+
+    # Add new data to the sheets in the Sheet and return headers & sheets details
+    # The temporary copies of the local files are tracked as soon as they are created
+    fingerprints = get_fingerprints(cogs_dir)
+    new_cached = {}
+    try:
+        sheet_rows, shifted, new_cached = push_data(
+            cogs_dir,
+            plan,
+            tracked_sheets,
+            remote_sheets,
+            fingerprints,
+            incremental=incremental,
+            untouched=untouched,
+            extents=get_grid_extents(sheet_formats, sheet_notes, data_validation),
+            padding=padding,
+            new_cached=new_cached,
+        )
+
+        # Remove sheets from remote if needed
+        for sheet_title, sheet in remote_sheets.items():
+            if sheet_title not in tracked_sheets.keys():
+                logging.info(f"removing sheet '{sheet_title}'")
+                # Remove remote copy
+                plan.add("delete", {"deleteSheet": {"sheetId": sheet.id}})
+                # Remove cached copy
+                if os.path.exists(f"{cogs_dir}/tracked/{sheet_title}.tsv"):
+                    os.remove(f"{cogs_dir}/tracked/{sheet_title}.tsv")
+
+        # Get the sheets where formatting, notes, or data validation need to be pushed
+        # These are all sheets that were cleared, and the incrementally pushed sheets where these
+        # have changed since the last sync or where rows have moved (after clearing them)
+        push_kinds = {"Formats": set(), "Notes": set(), "Validation": set()}
+        for details in sheet_rows:
+            sheet_title = details["Title"]
+            if details.get("Ignore") or sheet_title in untouched or sheet_title not in fingerprints:
+                continue
+            hashes = get_sheet_hashes(
+                sheet_formats.get(sheet_title, {}),
+                sheet_notes.get(sheet_title, {}),
+                data_validation.get(sheet_title, []),
+            )
+            for kind, field in [
+                ("Formats", "userEnteredFormat"),
+                ("Notes", "note"),
+                ("Validation", "dataValidation"),
+            ]:
+                if sheet_title not in incremental:
+                    push_kinds[kind].add(sheet_title)
+                elif sheet_title in shifted or hashes[kind] != fingerprints[sheet_title].get(kind):
+                    push_kinds[kind].add(sheet_title)
+                    plan.add("metadata", get_clear_request(details["ID"], field))
+            fingerprints[sheet_title].update(hashes)
+
+        # Add formatting, notes, and data validation
+        push_data_validation(
+            plan,
+            {x: y for x, y in data_validation.items() if x in push_kinds["Validation"]},
+            tracked_sheets,
+        )
+        push_formats(
+            plan,
+            id_to_format,
+            {x: y for x, y in sheet_formats.items() if x in push_kinds["Formats"]},
+            tracked_sheets,
+        )
+        push_notes(
+            plan,
+            {x: y for x, y in sheet_notes.items() if x in push_kinds["Notes"]},
+            tracked_sheets,
+        )
+
+        # Send the changes, then replace the cached copies
+        writes = plan.execute(spreadsheet, jobs=jobs)
+        for tmp_path, cached_path in new_cached.items():
+            os.replace(tmp_path, cached_path)
+    finally:
+        # The temporary files are removed if anything fails before they replace the cached copies
+        for tmp_path in new_cached:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # Record the fingerprints of pushed sheets
+    fingerprints = {st: fp for st, fp in fingerprints.items() if st in tracked_sheets}
+    update_fingerprints(cogs_dir, fingerprints)
 
     with open(f"{cogs_dir}/sheet.tsv", "w") as f:
         writer = csv.DictWriter(
@@ -280,6 +832,7 @@ def push(verbose=False):
                 "Description",
                 "Frozen Rows",
                 "Frozen Columns",
+                "Key Columns",
                 "Ignore",
             ],
         )
@@ -289,3 +842,17 @@ def push(verbose=False):
     # Remove renamed tracking
     if os.path.exists(f"{cogs_dir}/renamed.tsv"):
         os.remove(f"{cogs_dir}/renamed.tsv")
+
+    # The remote spreadsheet now matches the cached sheets, so the next push can be incremental,
+    # unless someone else has changed it since the version was checked before the push
+    state = get_fetch_state(cogs_dir)
+    synced_version = get_synced_version(
+        remote_version, get_remote_version(session.client, config["Spreadsheet ID"]), writes
+    )
+    if synced_version:
+        state["Synced Version"] = synced_version
+    else:
+        state.pop("Synced Version", None)
+    update_fetch_state(cogs_dir, state)
+
+    logging.info(session.scheduler.get_summary())
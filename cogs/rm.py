@@ -75,6 +75,7 @@ def rm(paths, keep=False, verbose=False):
                 "Description",
                 "Frozen Rows",
                 "Frozen Columns",
+                "Key Columns",
                 "Ignore",
             ],
         )
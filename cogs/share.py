@@ -1,7 +1,7 @@
 import gspread.exceptions
 import logging
 
-from cogs.helpers import get_client_from_config, get_config, set_logging, validate_cogs_project
+from cogs.helpers import get_config, get_session, set_logging, validate_cogs_project
 
 
 def share_spreadsheet(title, spreadsheet, user, role):
@@ -19,9 +19,9 @@ def share(email, role, verbose=False):
     cogs_dir = validate_cogs_project()
 
     config = get_config(cogs_dir)
-    gc = get_client_from_config(config)
+    session = get_session(config)
 
-    spreadsheet = gc.open_by_key(config["Spreadsheet ID"])
+    spreadsheet = session.client.open_by_key(config["Spreadsheet ID"])
     title = spreadsheet.title
 
     if role == "owner":
@@ -1,20 +1,86 @@
+import json
 import os
 import re
 import termcolor
 
+from cogs.exceptions import StatusError
 from cogs.helpers import (
     get_cached_sheets,
-    get_diff,
+    get_diff_summary,
+    get_file_hash,
+    get_index,
+    get_key_columns,
+    map_processes,
+    get_stat,
     set_logging,
+    update_index,
     validate_cogs_project,
     get_tracked_sheets,
     get_renamed_sheets,
 )
 
 
-def get_changes(cogs_dir, tracked_sheets, renamed):
-    """Get sets of changes between local and remote sheets. Return dict in format:
-    {"diffs": diffs built from daff (list of dicts),
+def get_sheet_changes(local_path, remote_path, old_entry, index_time, keys=None):
+    """Get the changes between the local and cached (remote) copies of a sheet, or None if they have
+    the same values. Return the new index entry of the sheet (see get_index), with the stat data
+    and hashes of both copies and the changes, and the changes. A file is only hashed if its stat
+    data has changed since the index was written, and the diff is only run if either hash or the
+    key columns have changed. Only the summary of the diff is computed (see get_diff_summary)."""
+    entry = dict(old_entry)
+    entry["Key Columns"] = ", ".join(keys or [])
+    hashes = {}
+    for kind, path in [("Local", local_path), ("Cached", remote_path)]:
+        stat = get_stat(path)
+        # A file changed in the same instant the index was written may have changed again since
+        mtime = int(stat.split(":")[1])
+        if entry.get(f"{kind} Stat") != stat or mtime >= index_time:
+            entry[f"{kind} Stat"] = stat
+            entry[f"{kind} Hash"] = get_file_hash(path)
+        hashes[kind] = entry[f"{kind} Hash"]
+
+    if hashes["Local"] == hashes["Cached"]:
+        entry["Status"] = ""
+        return entry, None
+    if (
+        "Status" in old_entry
+        and all(old_entry.get(f"{kind} Hash") == hashes[kind] for kind in hashes)
+        and (old_entry.get("Key Columns") or "") == entry["Key Columns"]
+    ):
+        # Neither copy nor the way they are compared has changed since the last status
+        if not old_entry["Status"]:
+            return entry, None
+        return entry, json.loads(old_entry["Status"])
+
+    # The new version is the copy that has changed since the last status
+    # If both (or neither) have changed, check which version is newer based on file modification
+    local_changed = old_entry.get("Local Hash") != hashes["Local"]
+    remote_changed = old_entry.get("Cached Hash") != hashes["Cached"]
+    if remote_changed and not local_changed:
+        new_version = "remote"
+    elif local_changed and not remote_changed:
+        new_version = "local"
+    elif os.path.getmtime(remote_path) > os.path.getmtime(local_path):
+        new_version = "remote"
+    else:
+        new_version = "local"
+
+    if new_version == "remote":
+        summary = get_diff_summary(local_path, remote_path, keys=keys)
+    else:
+        summary = get_diff_summary(remote_path, local_path, keys=keys)
+    if any(summary.values()):
+        changes = {"new_version": new_version}
+        changes.update(summary)
+        entry["Status"] = json.dumps(changes)
+        return entry, changes
+    entry["Status"] = ""
+    return entry, None
+
+
+def get_changes(cogs_dir, tracked_sheets, renamed, jobs=1):
+    """Get sets of changes between local and remote sheets. The sheets that exist in both are
+    diffed in up to 'jobs' processes. Return dict in format:
+    {"diffs": diff summaries (list of dicts),
      "added local": added_local (sheet names),
      "added remote": added_remote (sheet names),
      "removed local": removed_local (sheet names),
@@ -33,6 +99,10 @@ def get_changes(cogs_dir, tracked_sheets, renamed):
 
     untracked_cached = [x for x in cached_sheet_titles if x not in tracked_cached]
 
+    # The index of the local and cached copies, used to skip diffing sheets that have not changed
+    index, index_time = get_index(cogs_dir)
+    sheet_jobs = []
+
     # Get tracked titles that have local copies
     local_sheet_titles = []
 
@@ -103,48 +173,32 @@ def get_changes(cogs_dir, tracked_sheets, renamed):
                 # Subject to a rename
                 continue
 
-            # Check which version is newer based on file modification
-            local_mod = os.path.getmtime(local_path)
-            remote_mod = os.path.getmtime(remote_path)
-            if remote_mod > local_mod:
-                # Remote is newer
-                diff = get_diff(local_path, remote_path)
-                new_version = "remote"
-            else:
-                # Local is newer
-                diff = get_diff(remote_path, local_path)
-                new_version = "local"
-
-            if len(diff) > 1:
-                added_lines = 0
-                removed_lines = 0
-                changed_lines = 0
-                added_cols = 0
-                removed_cols = 0
-                for idx in range(0, len(diff)):
-                    d = diff[idx]
-                    if idx == 0 and d[0] == "!":
-                        # Get changed columns
-                        for h in d:
-                            if h == "+++":
-                                added_cols += 1
-                            elif h == "---":
-                                removed_cols += 1
-                        continue
-                    if d[0] == "---":
-                        removed_lines += 1
-                    elif d[0] == "+++":
-                        added_lines += 1
-                    elif d[0] == "->":
-                        changed_lines += 1
-                diffs[sheet_title] = {
-                    "new_version": new_version,
-                    "added_cols": added_cols,
-                    "removed_cols": removed_cols,
-                    "added_lines": added_lines,
-                    "removed_lines": removed_lines,
-                    "changed_lines": changed_lines,
-                }
+            sheet_jobs.append((sheet_title, local_path, remote_path))
+
+    # Diff the sheets in the order they are tracked
+    sheet_jobs.sort(key=lambda job: tracked_sheet_titles.index(job[0]))
+    results = map_processes(
+        get_sheet_changes,
+        [
+            (
+                local_path,
+                remote_path,
+                index.get(sheet_title, {}),
+                index_time,
+                get_key_columns(tracked_sheets[sheet_title]),
+            )
+            for sheet_title, local_path, remote_path in sheet_jobs
+        ],
+        jobs=jobs,
+    )
+    new_index = {}
+    for (sheet_title, _, _), (entry, changes) in zip(sheet_jobs, results):
+        new_index[sheet_title] = entry
+        if changes:
+            diffs[sheet_title] = changes
+
+    if new_index != index:
+        update_index(cogs_dir, new_index)
 
     return {
         "diffs": diffs,
@@ -295,16 +349,19 @@ def print_status(changes, renamed, tracked_sheets):
     print("")
 
 
-def status(use_screen=True, verbose=False):
+def status(jobs=1, use_screen=True, verbose=False):
     """Return a dict containing:
     - changes (dict of new_version, added_cols, removed_cols, added_lines, removed_lines,
-      changed_lines built from daff)
+      changed_lines from get_diff_summary)
     - added local (sheet names)
     - removed local (sheet names)
     - added remote (sheet names)
     - removed remote (sheet names)
-    If use_screen, print the status of local sheets vs. remote sheets."""
+    The sheets are diffed in up to 'jobs' processes. If use_screen, print the status of local
+    sheets vs. remote sheets."""
     set_logging(verbose)
+    if jobs < 1:
+        raise StatusError(f"the number of jobs must be at least 1 (got {jobs})")
     cogs_dir = validate_cogs_project()
 
     # Get the sets of changes
@@ -312,7 +369,7 @@ def status(use_screen=True, verbose=False):
     # Get rid of ignored sheets
     tracked_sheets = {x: y for x, y in tracked_sheets.items() if not y.get("Ignore")}
     renamed = get_renamed_sheets(cogs_dir)
-    changes = get_changes(cogs_dir, tracked_sheets, renamed)
+    changes = get_changes(cogs_dir, tracked_sheets, renamed, jobs=jobs)
 
     # Get a count of all changes
     change_count = set(
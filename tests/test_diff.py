@@ -0,0 +1,28 @@
+import importlib
+import multiprocessing
+import time
+
+# cogs.diff is also the name of the diff function in the cogs package
+diff = importlib.import_module("cogs.diff")
+
+
+def slow_diff(seconds):
+    time.sleep(seconds)
+    return [[str(seconds)]]
+
+
+def test_get_sheet_diffs(monkeypatch):
+    """Test that the sheet diffs are yielded in order, and that the processes that are still
+    diffing are stopped when the generator is closed early."""
+    monkeypatch.setattr(diff, "get_diff", slow_diff)
+    sheet_jobs = {"a": (0.2,), "b": (0,)}
+    assert list(diff.get_sheet_diffs(sheet_jobs, jobs=2)) == [("a", [["0.2"]]), ("b", [["0"]])]
+    assert list(diff.get_sheet_diffs(sheet_jobs)) == [("a", [["0.2"]]), ("b", [["0"]])]
+
+    sheet_jobs = {"a": (0,), "b": (60,), "c": (60,), "d": (60,)}
+    sheet_diffs = diff.get_sheet_diffs(sheet_jobs, jobs=2)
+    assert next(sheet_diffs) == ("a", [["0"]])
+    sheet_diffs.close()
+    for process in multiprocessing.active_children():
+        process.join(5)
+        assert not process.is_alive()
@@ -0,0 +1,101 @@
+import importlib
+import json
+import os
+
+from types import SimpleNamespace
+from cogs.fetch import process_sheet, process_sheets
+
+# cogs.fetch is also the name of the fetch function in the cogs package
+fetch = importlib.import_module("cogs.fetch")
+
+BOLD = {"textFormat": {"bold": True}}
+RED = {"backgroundColor": {"red": 1}}
+ONE_OF = {"condition": {"type": "ONE_OF_LIST", "values": [{"userEnteredValue": "x"}]}}
+
+
+def cell(value="", fmt=None, **kwargs):
+    cell = {"formattedValue": value} if value else {}
+    if fmt:
+        cell["userEnteredFormat"] = fmt
+    cell.update(kwargs)
+    return cell
+
+
+def test_process_sheet(tmp_path):
+    """Test that cells with the same format or data validation rule are merged into rectangles
+    from row-major runs across windows of rows, with empty rows and windows."""
+    os.makedirs(tmp_path / "tracked")
+    header = {"values": [cell("id", BOLD), cell("label", BOLD), cell("kind", BOLD)]}
+    rows = [header]
+    for i in range(2, 12):
+        rows.append({"values": [cell(str(i)), cell(fmt=RED), cell("x", dataValidation=ONE_OF)]})
+    # Rows 5 and 7 have no values, and row 12 is empty
+    rows[4] = {"values": [cell(), cell(fmt=RED)]}
+    rows[6] = {"values": [cell(), cell(fmt=RED, note="a\nb")]}
+    rows.append({})
+    windows = [
+        {"startRow": 0, "rowData": rows[:4]},
+        {"startRow": 4, "rowData": []},
+        {"startRow": 4, "rowData": rows[4:9]},
+        {"startRow": 9, "rowData": rows[9:]},
+    ]
+    result = process_sheet(str(tmp_path), "Sheet 1", windows)
+    assert result["formats"] == {
+        "A1:C1": json.dumps(BOLD, sort_keys=True),
+        "B2:B11": json.dumps(RED, sort_keys=True),
+    }
+    assert result["notes"] == {"B7": "a\\nb"}
+    assert [row["Range"] for row in result["data_validation"]] == ["C2:C4", "C6", "C8:C11"]
+    with open(tmp_path / "tracked" / "sheet_1.tsv") as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "id\tlabel\tkind"
+    assert lines[3:7] == ["4\t\tx", "\t\t", "6\t\tx", "\t\t"]
+    assert len(lines) == 11
+    # Only the tracked copy is left
+    assert os.listdir(tmp_path) == ["tracked"]
+
+
+class FakeSession:
+    """A session that returns one row with the sheet title for each requested sheet, and records
+    the cached sheets that exist when each request is made."""
+
+    def __init__(self, cogs_dir):
+        self.cogs_dir = cogs_dir
+        self.service = self
+        self.cached = []
+
+    def spreadsheets(self):
+        return self
+
+    def get(self, spreadsheetId=None, ranges=None, fields=None):
+        return ranges
+
+    def execute(self, ranges):
+        self.cached.append(sorted(os.listdir(os.path.join(self.cogs_dir, "tracked"))))
+        sheets = []
+        for a1_range in ranges:
+            title = a1_range.split("!")[0][1:-1].replace("''", "'")
+            row = {"values": [{"formattedValue": title}]}
+            sheets.append({"properties": {"title": title}, "data": [{"rowData": [row]}]})
+        return {"sheets": sheets}
+
+
+def test_process_sheets(tmp_path, monkeypatch):
+    """Test that each batch of sheets is processed as soon as it has been downloaded, before the
+    next batch is requested, and that the details are returned in sheet order."""
+    monkeypatch.setattr(fetch, "MAX_BATCH_CELLS", 10)
+    monkeypatch.setattr(fetch, "WINDOW_CELLS", 10)
+    os.makedirs(tmp_path / "tracked")
+    session = FakeSession(str(tmp_path))
+    sheets = {
+        "foo": SimpleNamespace(title="foo", row_count=2, col_count=5),
+        "bar": SimpleNamespace(title="it's", row_count=2, col_count=5),
+        "big": SimpleNamespace(title="big", row_count=1, col_count=20),
+    }
+    details = process_sheets(
+        str(tmp_path), session, SimpleNamespace(id="1"), sheets, "fields", {}, jobs=1
+    )
+    assert list(details.keys()) == ["foo", "bar", "big"]
+    assert session.cached == [[], ["foo.tsv"], ["bar.tsv", "foo.tsv"]]
+    with open(tmp_path / "tracked" / "bar.tsv") as f:
+        assert f.read() == "it's\n"
@@ -0,0 +1,450 @@
+import cogs.helpers
+import csv
+import datetime
+import email.utils
+import gspread.exceptions
+import httplib2
+import pytest
+import random
+
+from types import SimpleNamespace
+from cogs.helpers import (
+    MAX_BACKOFF,
+    RequestScheduler,
+    TokenBucket,
+    add_row_runs,
+    close_ranges,
+    get_cached_token,
+    get_diff,
+    get_diff_summary,
+    get_retry_details,
+    is_idempotent,
+    merge_ranges,
+    update_cached_token,
+)
+from googleapiclient.errors import HttpError
+
+HEADERS = ["id", "a", "b"]
+ROWS = [[str(i), f"x{i}", "y"] for i in range(10)]
+
+
+def write_table(path, rows):
+    with open(path, "w") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerows(rows)
+
+
+def get_diffs(tmp_path, left, right):
+    """Return the daff diff and the diff keyed on 'id' between two tables."""
+    write_table(tmp_path / "left.tsv", left)
+    write_table(tmp_path / "right.tsv", right)
+    left_path = str(tmp_path / "left.tsv")
+    right_path = str(tmp_path / "right.tsv")
+    return get_diff(left_path, right_path), get_diff(left_path, right_path, keys=["id"])
+
+
+def count_changes(diff):
+    """Return the column changes and the number of added, removed, and changed rows of a diff."""
+    col_changes = diff[0][1:] if diff and diff[0][0] == "!" else []
+    return (
+        sorted(col_changes),
+        len([line for line in diff if line[0] == "+++"]),
+        len([line for line in diff if line[0] == "---"]),
+        len([line for line in diff if line[0] == "->"]),
+    )
+
+
+def add_column(rows, values):
+    return [row + [values.get(i, "")] for i, row in enumerate(rows)]
+
+
+def remove_column(rows, idx):
+    return [row[:idx] + row[idx + 1 :] for row in rows]
+
+
+def move_column(rows):
+    return [[row[0], row[2], row[1]] for row in rows]
+
+
+def set_cell(rows, row, col, value):
+    rows = [list(r) for r in rows]
+    rows[row][col] = value
+    return rows
+
+
+TABLE = [HEADERS] + ROWS
+CASES = {
+    "changed row": set_cell(TABLE, 5, 2, "z"),
+    "added row": TABLE[:7] + [["99", "new", "y"]] + TABLE[7:],
+    "added row at end": TABLE + [["99", "new", "y"]],
+    "removed rows": TABLE[:3] + TABLE[4:8] + TABLE[9:],
+    "added column": add_column(TABLE, {0: "c", 4: "v"}),
+    "added column with values": add_column(TABLE, {i: str(i) for i in range(11)}),
+    "removed column": remove_column(TABLE, 2),
+    "removed column in place": remove_column(TABLE, 1),
+    "removed column and changed row": set_cell(remove_column(TABLE, 1), 3, 1, "z"),
+    "moved column": move_column(TABLE),
+    "moved column and changed row": set_cell(move_column(TABLE), 5, 2, "z"),
+    "mixed": add_column(
+        set_cell(TABLE[:2] + TABLE[3:8] + [["50", "n", "n"]] + TABLE[8:], 5, 1, "z"), {0: "c"}
+    ),
+}
+
+
+@pytest.mark.parametrize("case", CASES.keys())
+def test_keyed_diff(tmp_path, case):
+    """Test that the diff keyed on a column is the same as the daff diff."""
+    daff_diff, keyed_diff = get_diffs(tmp_path, TABLE, CASES[case])
+    assert keyed_diff == daff_diff
+
+
+def test_keyed_diff_unchanged(tmp_path):
+    """Test that the diffs of unchanged tables only have headers."""
+    daff_diff, keyed_diff = get_diffs(tmp_path, TABLE, TABLE)
+    assert len(daff_diff) == 1
+    assert keyed_diff == [["@@"] + HEADERS]
+
+
+def test_keyed_diff_moved_rows(tmp_path):
+    """Test that rows that have only moved are not changes in the keyed diff, and are not added,
+    removed, or changed rows in the daff diff."""
+    moved = TABLE[:3] + [TABLE[8]] + TABLE[3:8] + TABLE[9:]
+    daff_diff, keyed_diff = get_diffs(tmp_path, TABLE, moved)
+    assert keyed_diff == [["@@"] + HEADERS]
+    assert count_changes(daff_diff) == ([], 0, 0, 0)
+
+
+def test_keyed_diff_random(tmp_path):
+    """Test that the diff keyed on a column has the same changes as the daff diff for random
+    changes to the rows."""
+    rand = random.Random(0)
+    for _ in range(100):
+        size = rand.randint(0, 20)
+        rows = [[str(i), rand.choice("abc"), rand.choice("xyz")] for i in range(size)]
+        new_rows = [list(row) for row in rows]
+        for _ in range(rand.randint(0, 4)):
+            op = rand.random()
+            if op < 0.3 and new_rows:
+                del new_rows[rand.randrange(len(new_rows))]
+            elif op < 0.6:
+                new_id = str(1000 + rand.randint(0, 99999))
+                new_rows.insert(rand.randint(0, len(new_rows)), [new_id, "q", "q"])
+            elif new_rows:
+                new_rows[rand.randrange(len(new_rows))][2] = "changed"
+        daff_diff, keyed_diff = get_diffs(tmp_path, [HEADERS] + rows, [HEADERS] + new_rows)
+        assert count_changes(keyed_diff) == count_changes(daff_diff)
+
+
+def test_keyed_diff_fallback(tmp_path):
+    """Test that tables with duplicate keys or without the key columns are diffed by daff."""
+    duplicates = TABLE + [["1", "x1", "z"]]
+    daff_diff, keyed_diff = get_diffs(tmp_path, TABLE, duplicates)
+    assert keyed_diff == daff_diff
+    no_key = [["name", "a", "b"]] + ROWS
+    daff_diff, keyed_diff = get_diffs(tmp_path, TABLE, no_key)
+    assert keyed_diff == daff_diff
+
+
+def get_summary(tmp_path, left, right, keys=None):
+    """Return the diff summary of two tables as (added_cols, removed_cols, added_lines,
+    removed_lines, changed_lines)."""
+    write_table(tmp_path / "left.tsv", left)
+    write_table(tmp_path / "right.tsv", right)
+    summary = get_diff_summary(str(tmp_path / "left.tsv"), str(tmp_path / "right.tsv"), keys=keys)
+    return tuple(
+        summary[k]
+        for k in ["added_cols", "removed_cols", "added_lines", "removed_lines", "changed_lines"]
+    )
+
+
+@pytest.mark.parametrize("keys", [None, ["id"]])
+def test_diff_summary(tmp_path, keys):
+    """Test that the diff summary counts the added, removed, and changed lines and columns, with
+    and without key columns."""
+    assert get_summary(tmp_path, TABLE, TABLE, keys) == (0, 0, 0, 0, 0)
+    assert get_summary(tmp_path, TABLE, CASES["changed row"], keys) == (0, 0, 0, 0, 1)
+    assert get_summary(tmp_path, TABLE, CASES["added row"], keys) == (0, 0, 1, 0, 0)
+    assert get_summary(tmp_path, TABLE, CASES["removed rows"], keys) == (0, 0, 0, 2, 0)
+    # Without keys, the added and removed rows are paired up as changed rows
+    mixed = (1, 0, 1, 1, 1) if keys else (1, 0, 0, 0, 2)
+    assert get_summary(tmp_path, TABLE, CASES["mixed"], keys) == mixed
+    # Rows that have only moved are not changes
+    moved = TABLE[:3] + [TABLE[8]] + TABLE[3:8] + TABLE[9:]
+    assert get_summary(tmp_path, TABLE, moved, keys) == (0, 0, 0, 0, 0)
+    # Only the values in columns that are in both tables are compared
+    assert get_summary(tmp_path, TABLE, CASES["added column with values"], keys) == (1, 0, 0, 0, 0)
+    assert get_summary(tmp_path, TABLE, CASES["removed column"], keys) == (0, 1, 0, 0, 0)
+    assert get_summary(tmp_path, TABLE, CASES["moved column"], keys) == (0, 0, 0, 0, 0)
+    changed = CASES["removed column and changed row"]
+    assert get_summary(tmp_path, TABLE, changed, keys) == (0, 1, 0, 0, 1)
+
+
+def test_diff_summary_keys(tmp_path):
+    """Test that with key columns, only an added and a removed row with the same key are a changed
+    row. Without key columns, as many added and removed rows as possible are changed rows."""
+    replaced = TABLE[:3] + [["99", "new", "y"]] + TABLE[4:]
+    assert get_summary(tmp_path, TABLE, replaced) == (0, 0, 0, 0, 1)
+    assert get_summary(tmp_path, TABLE, replaced, ["id"]) == (0, 0, 1, 1, 0)
+    # Rows with the same key as a removed row are changed rows, the others are added rows
+    rows = set_cell(replaced, 5, 1, "z") + [["100", "new", "y"]]
+    assert get_summary(tmp_path, TABLE, rows, ["id"]) == (0, 0, 2, 1, 1)
+    # Key columns that are not in both tables are not used
+    renamed = [["name", "a", "b"]] + ROWS
+    assert get_summary(tmp_path, renamed, replaced, ["name"]) == (1, 1, 0, 0, 1)
+
+
+def test_diff_summary_headers(tmp_path):
+    """Test the diff summary of tables with no columns in common and of empty tables."""
+    renamed = [["name", "c", "d"]] + ROWS
+    assert get_summary(tmp_path, TABLE, renamed) == (3, 3, 10, 10, 0)
+    assert get_summary(tmp_path, TABLE, renamed, ["id"]) == (3, 3, 10, 10, 0)
+    assert get_summary(tmp_path, [], []) == (0, 0, 0, 0, 0)
+    assert get_summary(tmp_path, [], TABLE) == (3, 0, 10, 0, 0)
+    assert get_summary(tmp_path, TABLE, []) == (0, 3, 0, 10, 0)
+    assert get_summary(tmp_path, [HEADERS], TABLE, ["id"]) == (0, 0, 10, 0, 0)
+    assert get_summary(tmp_path, TABLE, [HEADERS]) == (0, 0, 0, 10, 0)
+
+
+def test_add_row_runs():
+    """Test that runs on consecutive rows with the same columns and key are merged, and that a gap
+    or a change of columns or key starts a new rectangle."""
+    open_ranges = {}
+    ranges = []
+    add_row_runs(open_ranges, ranges, 1, [(1, 3, "a")])
+    add_row_runs(open_ranges, ranges, 2, [(1, 3, "a"), (5, 5, "b")])
+    add_row_runs(open_ranges, ranges, 3, [(1, 2, "a"), (5, 5, "b")])
+    # Row 4 is empty
+    add_row_runs(open_ranges, ranges, 5, [(5, 5, "b")], end_row=10)
+    add_row_runs(open_ranges, ranges, 11, [(5, 5, "b")])
+    add_row_runs(open_ranges, ranges, 12, [(5, 5, "c")])
+    close_ranges(open_ranges, ranges)
+    assert sorted(ranges) == [
+        (1, 1, 2, 3, "a"),
+        (2, 5, 3, 5, "b"),
+        (3, 1, 3, 2, "a"),
+        (5, 5, 11, 5, "b"),
+        (12, 5, 12, 5, "c"),
+    ]
+
+
+def test_merge_ranges():
+    """Test that ranges are merged into as few rectangles as possible."""
+    assert merge_ranges([]) == {}
+    # Single cells
+    assert merge_ranges([("B2", "x")]) == {"B2": "x"}
+    assert merge_ranges([("B2", "x"), ("C2", "y")]) == {"B2": "x", "C2": "y"}
+    # Cells with gaps
+    assert merge_ranges([("C2", "x"), ("C3", "x"), ("C5", "x")]) == {"C2:C3": "x", "C5": "x"}
+    # Adjacent ranges with the same key
+    assert merge_ranges([("A1:A5", "x"), ("B1:B5", "x"), ("C1:C5", "y")]) == {
+        "A1:B5": "x",
+        "C1:C5": "y",
+    }
+    # Overlapping ranges
+    assert merge_ranges([("A1:A2", "x"), ("A2:A4", "x"), ("A1", "x")]) == {"A1:A4": "x"}
+    assert merge_ranges([("A1:B2", "x"), ("B2:C3", "x")]) == {
+        "A1:B1": "x",
+        "A2:C2": "x",
+        "B3:C3": "x",
+    }
+    # Whole columns are not split into cells
+    assert merge_ranges([("C2:C1000000", "x"), ("D2:D1000000", "x")]) == {"C2:D1000000": "x"}
+
+
+def test_merge_ranges_fragmented():
+    """Test that ranges split into single cells (e.g., from older versions of COGS) are merged."""
+    a1_ranges = []
+    for row in range(2, 4002):
+        a1_ranges.append((f"C{row}", "x"))
+        a1_ranges.append((f"D{row}", "x" if row % 1000 else "y"))
+    assert merge_ranges(a1_ranges) == {
+        "C2:D999": "x",
+        "C1000": "x",
+        "D1000": "y",
+        "C1001:D1999": "x",
+        "C2000": "x",
+        "D2000": "y",
+        "C2001:D2999": "x",
+        "C3000": "x",
+        "D3000": "y",
+        "C3001:D3999": "x",
+        "C4000": "x",
+        "D4000": "y",
+        "C4001:D4001": "x",
+    }
+
+
+def test_cached_token(tmp_path, monkeypatch):
+    """Test that a cached access token is read back with its expiry, and that it is only used when
+    it is valid for long enough."""
+    monkeypatch.setenv("COGS_TOKEN_CACHE", "true")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    now = datetime.datetime.utcnow()
+    # Expiry times are read back with or without microseconds
+    hour = datetime.timedelta(hours=1)
+    for expiry in [now.replace(microsecond=0) + hour, now.replace(microsecond=1) + hour]:
+        gcred = SimpleNamespace(
+            service_account_email="cogs@example.com", scopes=["a"], token="abc", expiry=expiry
+        )
+        update_cached_token(gcred)
+        cached = SimpleNamespace(
+            service_account_email="cogs@example.com", scopes=["a"], token=None, expiry=None
+        )
+        get_cached_token(cached)
+        assert (cached.token, cached.expiry) == ("abc", expiry)
+    gcred.expiry = now
+    update_cached_token(gcred)
+    cached.token = None
+    get_cached_token(cached)
+    assert cached.token is None
+
+
+class FakeResponse:
+    """A requests Response with a status and headers, for gspread APIErrors."""
+
+    def __init__(self, status, headers=None):
+        self.status_code = status
+        self.headers = headers or {}
+        self.text = f"Error {status}"
+
+    def json(self):
+        raise ValueError()
+
+
+def api_error(status, retry_after=None):
+    headers = {"Retry-After": retry_after} if retry_after is not None else {}
+    return gspread.exceptions.APIError(FakeResponse(status, headers))
+
+
+def http_error(status, retry_after=None):
+    resp = {"status": str(status)}
+    if retry_after is not None:
+        resp["retry-after"] = retry_after
+    return HttpError(httplib2.Response(resp), b"")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace time.monotonic and time.sleep with a clock that only moves when sleeping, and
+    return the list of sleeps."""
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(cogs.helpers.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(cogs.helpers.time, "sleep", sleep)
+    monkeypatch.setattr(cogs.helpers.random, "random", lambda: 0.5)
+    return sleeps
+
+
+def failing(errors):
+    """Return a request that raises each error in turn, then returns 'ok', and the list of calls."""
+    calls = []
+
+    def send():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "ok"
+
+    return send, calls
+
+
+def test_get_retry_details():
+    """Test that the status and Retry-After delay are read from both kinds of errors."""
+    assert get_retry_details(api_error(429)) == (429, None)
+    assert get_retry_details(api_error(503, "2.5")) == (503, 2.5)
+    assert get_retry_details(api_error(503, "-1")) == (503, 0.0)
+    assert get_retry_details(api_error(503, "soon")) == (503, None)
+    assert get_retry_details(http_error(500)) == (500, None)
+    assert get_retry_details(http_error(429, "7")) == (429, 7.0)
+    # Retry-After may be an HTTP date
+    retry_at = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=60)
+    status, delay = get_retry_details(http_error(429, email.utils.format_datetime(retry_at)))
+    assert status == 429
+    assert 55 < delay <= 60
+    past = email.utils.format_datetime(retry_at - datetime.timedelta(hours=1))
+    assert get_retry_details(api_error(503, past)) == (503, 0.0)
+
+
+def test_is_idempotent():
+    """Test that only requests that can safely be sent twice are idempotent."""
+    base = "https://sheets.googleapis.com/v4/spreadsheets/1"
+    assert is_idempotent("get", base)
+    assert is_idempotent("post", base + "/values:batchUpdate", {"data": []})
+    assert is_idempotent("post", base + "/values/A1:clear")
+    assert not is_idempotent("post", base + "/values/A1:append")
+    update = {"updateCells": {"range": {"sheetId": 0}, "fields": "*"}}
+    insert = {"insertDimension": {"range": {"sheetId": 0, "dimension": "ROWS"}}}
+    assert is_idempotent("post", base + ":batchUpdate", {"requests": [update]})
+    assert not is_idempotent("post", base + ":batchUpdate", {"requests": [update, insert]})
+    assert not is_idempotent("post", "https://www.googleapis.com/drive/v3/files", {"name": "x"})
+
+
+def test_retry_backoff(clock):
+    """Test that requests are retried with exponential backoff (with jitter) on 429 and 5xx
+    responses, waiting for Retry-After when it is given."""
+    scheduler = RequestScheduler(reads_per_minute=6000, max_retries=10)
+    errors = [api_error(429), http_error(503), api_error(500), api_error(429, "3")]
+    errors += [api_error(502)] * 5
+    send, calls = failing(errors)
+    assert scheduler.call("read", send) == "ok"
+    assert len(calls) == 10
+    assert clock == [1.5, 2.5, 4.5, 3.0, 16.5, 32.5, MAX_BACKOFF + 0.5, MAX_BACKOFF + 0.5, 64.5]
+    assert scheduler.metrics["requests"] == 10
+    assert scheduler.metrics["retries"] == 9
+    assert scheduler.metrics["throttled"] == sum(clock)
+
+
+def test_retry_limit(clock):
+    """Test that a request is only retried max_retries times, and that other errors are not
+    retried."""
+    scheduler = RequestScheduler(max_retries=2)
+    send, calls = failing([api_error(500)] * 3)
+    with pytest.raises(gspread.exceptions.APIError):
+        scheduler.call("write", send)
+    assert len(calls) == 3
+    send, calls = failing([api_error(400)])
+    with pytest.raises(gspread.exceptions.APIError):
+        scheduler.call("write", send)
+    assert len(calls) == 1
+
+
+def test_retry_not_idempotent(clock):
+    """Test that requests that are not idempotent are retried on 429 responses, which are never
+    applied, but not on 5xx responses, which may have been applied."""
+    scheduler = RequestScheduler()
+    send, calls = failing([api_error(429), api_error(503)])
+    with pytest.raises(gspread.exceptions.APIError):
+        scheduler.call("write", send, idempotent=False)
+    assert len(calls) == 2
+
+
+def test_token_bucket(clock):
+    """Test that a token bucket allows a burst of requests up to its capacity, and then one
+    request per 1 / rate seconds."""
+    bucket = TokenBucket(rate=2, capacity=3)
+    waits = [bucket.acquire() for _ in range(6)]
+    assert waits == [0, 0, 0, 0.5, 0.5, 0.5]
+    assert clock == [0.5, 0.5, 0.5]
+    # After waiting, the bucket is refilled up to its capacity
+    clock.clear()
+    cogs.helpers.time.sleep(10)
+    waits = [bucket.acquire() for _ in range(4)]
+    assert waits == [0, 0, 0, 0.5]
+
+
+def test_scheduler_throttling(clock):
+    """Test that reads and writes are throttled by their own quotas."""
+    scheduler = RequestScheduler(reads_per_minute=60, writes_per_minute=600)
+    # Bursts are limited to a tenth of the quota
+    for _ in range(7):
+        scheduler.call("read", lambda: "ok")
+    assert clock == [1.0]
+    for _ in range(70):
+        scheduler.call("write", lambda: "ok")
+    assert clock == pytest.approx([1.0] + [0.1] * 10)
+    assert scheduler.metrics["throttled"] == pytest.approx(2.0)
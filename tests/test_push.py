@@ -0,0 +1,254 @@
+import os
+import pytest
+import random
+
+from types import SimpleNamespace
+
+from cogs.helpers import get_file_hash, update_fingerprints
+from cogs.push import (
+    PushPlan,
+    clear_remote_sheets,
+    get_clear_request,
+    get_incremental_sheets,
+    get_row_changes,
+    get_row_key,
+    get_rows_to_append,
+    get_synced_version,
+    push_data,
+)
+
+
+class FakeSpreadsheet:
+    """A spreadsheet with worksheets that only have an ID and a title."""
+
+    def __init__(self, sheets):
+        self.sheets = [SimpleNamespace(id=sid, title=title) for sid, title in sheets]
+
+    def worksheets(self):
+        return self.sheets
+
+
+def test_clear_renamed_incremental_sheet():
+    """Test that a sheet renamed locally and then pulled is not cleared when it is pushed
+    incrementally, since the incremental and untouched sheets are known by their new title."""
+    spreadsheet = FakeSpreadsheet([(0, "foo"), (1, "other")])
+    tracked_sheets = {
+        "bar": {"ID": "0", "Path": "bar.tsv", "Ignore": False},
+        "other": {"ID": "1", "Path": "other.tsv", "Ignore": False},
+    }
+    renamed_local = {"foo": {"new": "bar", "path": "bar.tsv"}}
+    plan = PushPlan()
+    remote_sheets = clear_remote_sheets(
+        spreadsheet, plan, tracked_sheets, renamed_local, incremental={"bar"}
+    )
+    assert set(remote_sheets.keys()) == {"bar", "other"}
+    assert plan.requests["structure"] == [
+        {
+            "updateSheetProperties": {
+                "properties": {"sheetId": 0, "title": "bar"},
+                "fields": "title",
+            }
+        },
+        {"updateCells": {"range": {"sheetId": 1}, "fields": "*"}},
+    ]
+
+
+def test_clear_renamed_sheet():
+    """Test that a sheet renamed locally is cleared and renamed when it is not pushed
+    incrementally."""
+    spreadsheet = FakeSpreadsheet([(0, "foo")])
+    tracked_sheets = {"bar": {"ID": "0", "Path": "bar.tsv", "Ignore": False}}
+    renamed_local = {"foo": {"new": "bar", "path": "bar.tsv"}}
+    plan = PushPlan()
+    clear_remote_sheets(spreadsheet, plan, tracked_sheets, renamed_local)
+    assert plan.requests["structure"] == [
+        {"updateCells": {"range": {"sheetId": 0}, "fields": "*"}},
+        {
+            "updateSheetProperties": {
+                "properties": {"sheetId": 0, "title": "bar"},
+                "fields": "title",
+            }
+        },
+    ]
+
+
+def test_get_rows_to_append():
+    """Test that rows are only appended when deleting rows would leave no unfrozen rows."""
+    # Delete rows 2-13 of 13 with one frozen row
+    assert get_rows_to_append([("delete", 1, 13, 1, 1)], 13, 1) == 1
+    assert get_rows_to_append([("delete", 1, 13, 1, 1)], 14, 1) == 0
+    assert get_rows_to_append([("delete", 1, 13, 1, 1)], 13, 0) == 0
+    assert get_rows_to_append([("delete", 2, 13, 2, 2)], 13, 3) == 2
+    # Changes are made from the bottom up, so rows inserted below a delete are added first, but
+    # rows inserted above a delete are added too late to keep an unfrozen row
+    changes = [("delete", 1, 10, 1, 1), ("insert", 10, 10, 1, 3)]
+    assert get_rows_to_append(changes, 10, 1) == 0
+    changes = [("insert", 1, 1, 1, 3), ("delete", 5, 10, 7, 7)]
+    assert get_rows_to_append(changes, 10, 5) == 1
+
+
+def test_push_data_trim_to_frozen_rows(tmp_path):
+    """Test that a sheet with an exactly sized grid can be pushed incrementally after all of its
+    unfrozen rows are removed: the grid is grown before the rows are deleted."""
+    cogs_dir = tmp_path / ".cogs"
+    os.makedirs(cogs_dir / "tracked")
+    with open(cogs_dir / "tracked" / "foo.tsv", "w") as f:
+        f.write("id\tlabel\n1\ta\n2\tb\n")
+    with open(tmp_path / "foo.tsv", "w") as f:
+        f.write("id\tlabel\n")
+    tracked_sheets = {
+        "foo": {
+            "ID": "0",
+            "Path": str(tmp_path / "foo.tsv"),
+            "Frozen Rows": "1",
+            "Frozen Columns": "0",
+            "Ignore": False,
+        }
+    }
+    remote_sheets = {"foo": SimpleNamespace(id=0, row_count=3, frozen_row_count=1)}
+    plan = PushPlan()
+    _, shifted, new_cached = push_data(
+        str(cogs_dir), plan, tracked_sheets, remote_sheets, {}, incremental={"foo"}
+    )
+    for path in new_cached:
+        os.remove(path)
+    assert shifted == {"foo"}
+    kinds = [list(request.keys())[0] for request in plan.requests["structure"]]
+    assert kinds == ["appendDimension", "deleteDimension", "updateSheetProperties"]
+    assert plan.requests["structure"][0]["appendDimension"]["length"] == 1
+    assert plan.requests["structure"][1]["deleteDimension"]["range"]["endIndex"] == 3
+    assert plan.requests["structure"][2]["updateSheetProperties"]["properties"][
+        "gridProperties"
+    ] == {"rowCount": 2, "columnCount": 2, "frozenRowCount": 1, "frozenColumnCount": 0}
+
+
+def test_push_data_temporary_files(tmp_path):
+    """Test that the temporary copies of local files are created outside of the tracked directory
+    and are added to new_cached as they are created, even when a later sheet fails."""
+    cogs_dir = tmp_path / ".cogs"
+    os.makedirs(cogs_dir / "tracked")
+    with open(tmp_path / "foo.tsv", "w") as f:
+        f.write("id\tlabel\n1\ta\n")
+    details = {"Path": str(tmp_path / "foo.tsv"), "Frozen Rows": "0", "Frozen Columns": "0"}
+    tracked_sheets = {"foo": dict(details, ID="0"), "bar": dict(details, ID="1")}
+    # 'bar' is pushed incrementally but it has no cached copy
+    remote_sheets = {"foo": SimpleNamespace(id=0, row_count=2, frozen_row_count=0)}
+    new_cached = {}
+    with pytest.raises(FileNotFoundError):
+        push_data(
+            str(cogs_dir),
+            PushPlan(),
+            tracked_sheets,
+            remote_sheets,
+            {},
+            incremental={"bar"},
+            new_cached=new_cached,
+        )
+    assert len(new_cached) == 2
+    for tmp, cached_path in new_cached.items():
+        assert os.path.dirname(tmp) == str(cogs_dir)
+        os.remove(tmp)
+    assert os.listdir(cogs_dir / "tracked") == []
+
+
+def test_get_row_changes_random():
+    """Test that applying the row changes to the old rows gives the new rows, ignoring trailing
+    empty cells, for random edits."""
+    rand = random.Random(0)
+    values = ["a", "b", "c", ""]
+    for _ in range(500):
+        old_rows = [
+            [rand.choice(values) for _ in range(rand.randint(0, 3))]
+            for _ in range(rand.randint(0, 12))
+        ]
+        new_rows = [list(row) for row in old_rows]
+        for _ in range(rand.randint(0, 5)):
+            op = rand.random()
+            row = [rand.choice(values) for _ in range(rand.randint(0, 3))]
+            if op < 0.3 and new_rows:
+                del new_rows[rand.randrange(len(new_rows))]
+            elif op < 0.6:
+                new_rows.insert(rand.randint(0, len(new_rows)), row)
+            elif op < 0.8 and new_rows:
+                new_rows[rand.randrange(len(new_rows))] = row
+            elif new_rows:
+                # Only add a trailing empty cell, which is not a change
+                new_rows[rand.randrange(len(new_rows))].append("")
+        changes = get_row_changes(old_rows, new_rows)
+        assert all(tag != "equal" for tag, _, _, _, _ in changes)
+        rows = [get_row_key(row) for row in old_rows]
+        # Changes are applied from the bottom up, as in push_row_changes
+        for _, i1, i2, j1, j2 in reversed(changes):
+            rows[i1:i2] = [get_row_key(row) for row in new_rows[j1:j2]]
+        assert rows == [get_row_key(row) for row in new_rows]
+
+
+def test_get_incremental_sheets(tmp_path):
+    """Test that only sheets with an ID, whose cached copy matches their fingerprint, are pushed
+    incrementally, and only when the remote spreadsheet has not changed since it was synced."""
+    cogs_dir = str(tmp_path)
+    os.makedirs(tmp_path / "tracked")
+    fingerprints = {}
+    for sheet_title in ["same", "changed", "ignored", "new"]:
+        path = tmp_path / "tracked" / f"{sheet_title}.tsv"
+        with open(path, "w") as f:
+            f.write("id\tlabel\n1\ta\n")
+        fingerprints[sheet_title] = {"Values": get_file_hash(str(path))}
+    # The cached copy has changed since the last sync
+    with open(tmp_path / "tracked" / "changed.tsv", "a") as f:
+        f.write("2\tb\n")
+    # No fingerprint for the sheet that has not been synced yet
+    del fingerprints["new"]
+    update_fingerprints(cogs_dir, fingerprints)
+    tracked_sheets = {
+        "same": {"ID": "0"},
+        "changed": {"ID": "1"},
+        "ignored": {"ID": "2", "Ignore": True},
+        "new": {"ID": "3"},
+        "missing": {"ID": "4"},
+        "no id": {"ID": ""},
+    }
+    assert get_incremental_sheets(cogs_dir, tracked_sheets, True) == {"same"}
+    assert get_incremental_sheets(cogs_dir, tracked_sheets, False) == set()
+
+
+def test_get_synced_version():
+    """Test that the version after a push is only synced when the push is the only change since
+    the version before the push."""
+    assert get_synced_version({"Version": "10"}, {"Version": "13"}, 3) == "13"
+    assert get_synced_version({"Version": "10"}, {"Version": "10"}, 0) == "10"
+    # Someone else has changed the spreadsheet during the push
+    assert get_synced_version({"Version": "10"}, {"Version": "14"}, 3) is None
+    assert get_synced_version(None, {"Version": "13"}, 3) is None
+    assert get_synced_version({"Version": "10"}, None, 3) is None
+    assert get_synced_version({"Version": ""}, {"Version": "13"}, 3) is None
+
+
+class RecordingSpreadsheet:
+    """A spreadsheet that records the write requests it is sent."""
+
+    def __init__(self):
+        self.writes = []
+
+    def batch_update(self, body):
+        self.writes.append(("batch_update", len(body["requests"])))
+
+    def values_batch_update(self, body=None):
+        self.writes.append(("values_batch_update", len(body["data"])))
+
+
+def test_execute_writes():
+    """Test that executing a plan returns the number of write requests that were sent."""
+    plan = PushPlan()
+    assert plan.execute(RecordingSpreadsheet()) == 0
+    plan.add("structure", get_clear_request(0, "*"))
+    plan.add("validation", get_clear_request(0, "dataValidation"))
+    plan.add_values("foo", 1, [["a"]] * 10)
+    plan.add_values("bar", 1, [["b"]])
+    spreadsheet = RecordingSpreadsheet()
+    assert plan.execute(spreadsheet, jobs=2) == 3
+    assert spreadsheet.writes == [
+        ("batch_update", 1),
+        ("values_batch_update", 2),
+        ("batch_update", 1),
+    ]
@@ -0,0 +1,121 @@
+import importlib
+import os
+import pytest
+import time
+
+# cogs.status is also the name of the status function in the cogs package
+status = importlib.import_module("cogs.status")
+
+
+@pytest.fixture
+def sheets(tmp_path):
+    """Write a cached (remote) copy and a local copy of a sheet, and return their paths."""
+    remote_path = str(tmp_path / "remote.tsv")
+    local_path = str(tmp_path / "local.tsv")
+    with open(remote_path, "w") as f:
+        f.write("id\ta\n1\tx\n2\ty\n")
+    with open(local_path, "w") as f:
+        f.write("id\ta\n1\tz\n3\ty\n")
+    return local_path, remote_path
+
+
+def no_diff(*args, **kwargs):
+    raise AssertionError("the sheets should not be diffed")
+
+
+def test_sheet_changes_key_columns(sheets, monkeypatch):
+    """Test that the sheets are diffed again when the key columns change, even if neither copy has
+    changed since the last status."""
+    local_path, remote_path = sheets
+    entry, changes = status.get_sheet_changes(local_path, remote_path, {}, 0)
+    assert changes["changed_lines"] == 2
+    assert entry["Key Columns"] == ""
+
+    entry, changes = status.get_sheet_changes(local_path, remote_path, entry, 0, keys=["id"])
+    assert (changes["added_lines"], changes["removed_lines"], changes["changed_lines"]) == (1, 1, 1)
+    assert entry["Key Columns"] == "id"
+
+    # The summary with the same key columns is reused
+    monkeypatch.setattr(status, "get_diff_summary", no_diff)
+    _, cached_changes = status.get_sheet_changes(local_path, remote_path, entry, 0, keys=["id"])
+    assert cached_changes == changes
+
+
+def write_sheet(path, text):
+    """Write a sheet and set its modification time a minute in the past, so that it is older than
+    the index."""
+    with open(path, "w") as f:
+        f.write(text)
+    past = time.time() - 60
+    os.utime(path, (past, past))
+
+
+@pytest.fixture
+def project(tmp_path):
+    """Create a COGS directory with one tracked sheet that has been changed locally, and return
+    the COGS directory and tracked sheets."""
+    cogs_dir = str(tmp_path / ".cogs")
+    os.makedirs(os.path.join(cogs_dir, "tracked"))
+    write_sheet(os.path.join(cogs_dir, "tracked", "foo.tsv"), "id\ta\n1\tx\n2\ty\n")
+    write_sheet(str(tmp_path / "foo.tsv"), "id\ta\n1\tz\n3\ty\n")
+    tracked_sheets = {"foo": {"ID": "1", "Path": str(tmp_path / "foo.tsv"), "Key Columns": ""}}
+    return cogs_dir, tracked_sheets
+
+
+def get_diffs(cogs_dir, tracked_sheets):
+    return status.get_changes(cogs_dir, tracked_sheets, {})["diffs"]
+
+
+def test_index_reused(project, monkeypatch):
+    """Test that the status of a sheet is read from the index when neither copy has changed."""
+    cogs_dir, tracked_sheets = project
+    diffs = get_diffs(cogs_dir, tracked_sheets)
+    assert diffs["foo"]["new_version"] == "local"
+    assert diffs["foo"]["changed_lines"] == 2
+    assert os.path.exists(os.path.join(cogs_dir, "index.tsv"))
+
+    # Neither copy is read again
+    monkeypatch.setattr(status, "get_diff_summary", no_diff)
+    monkeypatch.setattr(status, "get_file_hash", no_diff)
+    assert get_diffs(cogs_dir, tracked_sheets) == diffs
+
+
+def test_index_local_changed(project):
+    """Test that the status of a sheet is computed again when the local copy changes."""
+    cogs_dir, tracked_sheets = project
+    get_diffs(cogs_dir, tracked_sheets)
+    write_sheet(tracked_sheets["foo"]["Path"], "id\ta\n1\tx\n2\ty\n3\tz\n")
+    diffs = get_diffs(cogs_dir, tracked_sheets)
+    assert diffs["foo"]["new_version"] == "local"
+    assert (diffs["foo"]["added_lines"], diffs["foo"]["changed_lines"]) == (1, 0)
+
+    # Once both copies are the same, there are no changes
+    write_sheet(tracked_sheets["foo"]["Path"], "id\ta\n1\tx\n2\ty\n")
+    assert get_diffs(cogs_dir, tracked_sheets) == {}
+
+
+def test_index_remote_changed(project):
+    """Test that the status of a sheet is computed again when a new version of the remote sheet
+    is fetched, which is then the newer version."""
+    cogs_dir, tracked_sheets = project
+    get_diffs(cogs_dir, tracked_sheets)
+    write_sheet(os.path.join(cogs_dir, "tracked", "foo.tsv"), "id\ta\n1\tz\n")
+    diffs = get_diffs(cogs_dir, tracked_sheets)
+    assert diffs["foo"]["new_version"] == "remote"
+    assert (diffs["foo"]["removed_lines"], diffs["foo"]["changed_lines"]) == (1, 0)
+
+
+def test_index_key_columns_changed(project, monkeypatch):
+    """Test that the status of a sheet is computed again when its key columns change in
+    sheet.tsv, and that the key columns are kept in the index."""
+    cogs_dir, tracked_sheets = project
+    get_diffs(cogs_dir, tracked_sheets)
+    tracked_sheets["foo"]["Key Columns"] = "id"
+    diffs = get_diffs(cogs_dir, tracked_sheets)
+    counts = [diffs["foo"][k] for k in ["added_lines", "removed_lines", "changed_lines"]]
+    assert counts == [1, 1, 1]
+    index, _ = status.get_index(cogs_dir)
+    assert index["foo"]["Key Columns"] == "id"
+
+    monkeypatch.setattr(status, "get_diff_summary", no_diff)
+    assert get_diffs(cogs_dir, tracked_sheets) == diffs